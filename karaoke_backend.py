@@ -2,12 +2,16 @@
 卡拉OK音轨处理后端服务
 功能：YouTube下载 + AI音轨分离
 """
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
+import time
+
+# 进程冷启动计时起点（在导入依赖之前记录）
+PROCESS_START = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
-import yt_dlp
 import os
 import uuid
 import subprocess
@@ -17,6 +21,17 @@ import asyncio
 import json
 import hashlib
 import shutil
+import itertools
+import wave
+import re
+import socket
+import struct
+import threading
+import platform
+import importlib.util
+from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -37,10 +52,39 @@ app.add_middleware(
 WORK_DIR = Path("./audio_workspace")
 WORK_DIR.mkdir(exist_ok=True)
 
-# 缓存目录
+# 缓存目录（使用共享缓存时作为本节点的本地读穿透层）
 CACHE_DIR = Path("./audio_cache")
 CACHE_DIR.mkdir(exist_ok=True)
 
+# 缓存后端：local（单机）或 shared（多节点共享目录，如 NFS 挂载）
+CACHE_BACKEND = os.environ.get('KARAOKE_CACHE_BACKEND', 'local')
+SHARED_CACHE_DIR = os.environ.get('KARAOKE_SHARED_CACHE_DIR')
+
+# 计算租约有效期（秒），持有者崩溃后其他节点在过期后接管；作业期间持续续租，因此可以较短
+CACHE_LEASE_SECONDS = int(os.environ.get('KARAOKE_CACHE_LEASE_SECONDS', '90'))
+
+# 作业排队和分离期间的续租间隔（秒）
+CACHE_LEASE_RENEW_SECONDS = max(CACHE_LEASE_SECONDS // 3, 1)
+
+# 等待其他节点结果时的轮询间隔（秒）
+CACHE_POLL_SECONDS = 5
+
+# 本进程的租约持有者标识
+CACHE_OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# 视频元数据缓存目录（与音频缓存并列，清空音频缓存不影响元数据）
+META_DIR = Path("./audio_meta_cache")
+META_DIR.mkdir(exist_ok=True)
+
+# 允许处理的最长时长（秒），超出的歌曲在下载前拒绝
+MAX_DURATION_SECONDS = int(os.environ.get('KARAOKE_MAX_DURATION', '900'))
+
+# 时长未知时用于估算任务开销的默认值（秒）
+DEFAULT_DURATION_SECONDS = 240
+
+# 排队老化：每等待 1 秒，预估开销抵扣的秒数（长歌曲不会被源源不断的短歌曲无限插队）
+JOB_AGING_RATE = 1.0
+
 # 任务状态存储
 tasks = {}
 
@@ -50,9 +94,128 @@ history = {}
 # 任务日志队列
 task_logs = {}
 
+# 批量任务存储
+batches = {}
+
+# 单个批量请求允许的最大条目数
+MAX_BATCH_SIZE = 100
+
+# 分离阶段前最多缓冲的已下载任务数（控制磁盘占用）
+SEPARATION_QUEUE_SIZE = 2
+
+# 同时进行的元数据查询数
+METADATA_CONCURRENCY = 4
+
+# 流水线队列：下载阶段 -> 分离阶段（按预估开销排序，短任务优先）
+download_queue: Optional[asyncio.PriorityQueue] = None
+separation_queue: Optional[asyncio.PriorityQueue] = None
+pipeline_workers = []
+background_jobs = set()
+job_sequence = itertools.count()
+metadata_semaphore = asyncio.Semaphore(METADATA_CONCURRENCY)
+
+# Demucs 引擎级故障（未安装、依赖缺失、显存不足）或连续多次失败后的冷却时间（秒），
+# 期间直接使用常驻 Spleeter；单首歌曲的失败（文件损坏、超时）不影响其他用户
+DEMUCS_RETRY_SECONDS = 300
+DEMUCS_MAX_CONSECUTIVE_FAILURES = 3
+DEMUCS_ENGINE_ERRORS = ('No module named', 'ImportError', 'CUDA out of memory', 'OutOfMemoryError')
+demucs_failed_at = None
+demucs_consecutive_failures = 0
+
+# 常驻 Spleeter 引擎（首次使用时加载，之后复用 TensorFlow 图和权重）
+# 每批最多为已取出的一个作业加上分离队列中缓冲的全部作业
+SPLEETER_SAMPLE_RATE = 44100
+SPLEETER_BATCH_SIZE = SEPARATION_QUEUE_SIZE + 1
+SPLEETER_BATCH_MAX_SECONDS = 1200
+spleeter_separator = None
+spleeter_lock = threading.RLock()
+
+# Demucs 模型名（也是其输出子目录名）
+DEMUCS_MODEL = 'htdemucs_ft'
+
+# 运行环境能力（设备、ffmpeg 路径、可用引擎、模型文件），启动时探测一次并缓存
+# 刷新时整体替换为新字典，读取方无需加锁
+capabilities = {}
+capabilities_lock = threading.Lock()
+
+# 启动时预先下载并校验模型权重，完成后才报告就绪
+PRELOAD_MODELS = os.environ.get('KARAOKE_PRELOAD_MODELS', '0') == '1'
+MODELS_READY_FILE = META_DIR / "models_ready.json"
+
+# 启动与就绪状态、冷启动耗时（秒，相对 PROCESS_START）
+startup_state = {
+    'ready': False,
+    'phase': 'starting',
+    'import_seconds': None,
+    'startup_seconds': None,
+    'ready_seconds': None,
+    'first_request_seconds': None,
+    'preload': None,
+}
+
+# 最近的 /health 响应耗时（毫秒）
+health_latencies = deque(maxlen=200)
+
+# 作业优先级（数值越小越优先）
+PRIORITY_USER = 0
+PRIORITY_WARM = 10
+
+# 视频元数据内存缓存（cache_key -> metadata）
+video_metadata = {}
+
+# 变调/变速渲染参数
+RENDITION_SAMPLE_RATE = 44100
+RENDITION_N_FFT = 2048
+RENDITION_HOP = 512
+RENDITION_BLOCK_FRAMES = 256
+MAX_SEMITONES = 12
+MIN_TEMPO = 0.5
+MAX_TEMPO = 2.0
+
+# 正在渲染的文件锁（同一版本只渲染一次）
+rendition_locks = {}
+
+# 导唱混音：从内存映射的音轨逐块计算
+MIX_BLOCK_FRAMES = 65536
+MIX_FILE_CHUNK_BYTES = 256 * 1024
+MAX_MIX_GAIN = 2.0
+
+# 常用增益组合预先编码为 MP3；其他组合被完整请求达到次数后也会编码
+MIX_PRESETS = {(0.2, 1.0), (0.3, 1.0), (0.5, 1.0)}
+MIX_PRESET_MIN_REQUESTS = 3
+mix_request_counts = {}
+
+# 进行中的 MP3 编码（预设文件路径 -> asyncio.Task）
+mix_encoding = {}
+
+# 歌曲热度统计（canonical song id -> stats），持久化到元数据目录
+POPULARITY_FILE = META_DIR / "popularity.json"
+song_popularity = {}
+popularity_dirty = False
+
+# 缓存预热：空闲时预先分离种子列表和热门歌曲
+WARM_ENABLED = os.environ.get('KARAOKE_WARM_ENABLED', '1') == '1'
+WARM_SEED_FILE = os.environ.get('KARAOKE_WARM_SEED_FILE')
+WARM_TOP_N = int(os.environ.get('KARAOKE_WARM_TOP_N', '20'))
+WARM_INTERVAL_SECONDS = int(os.environ.get('KARAOKE_WARM_INTERVAL', '30'))
+WARM_MAX_ATTEMPTS = 3
+
+# 预热失败次数（超过上限后不再尝试）
+warm_attempts = {}
+
+class JobCancelled(Exception):
+    """预热作业为用户作业让出资源时抛出"""
+
+# 正在排队或处理中的作业（按缓存键去重）
+inflight_jobs = {}
+
 class YouTubeRequest(BaseModel):
     url: str
 
+class BatchRequest(BaseModel):
+    urls: list[str] = []
+    playlist_url: Optional[str] = None
+
 class TaskStatus(BaseModel):
     task_id: str
     status: str  # pending, downloading, separating, completed, error
@@ -62,6 +225,46 @@ class TaskStatus(BaseModel):
     vocal_url: Optional[str] = None
     instrumental_url: Optional[str] = None
     lyrics: Optional[str] = None
+    duration: Optional[float] = None
+
+class BatchStatus(BaseModel):
+    batch_id: str
+    status: str  # processing, completed, error
+    progress: int
+    message: str
+    total: int
+    completed: int
+    failed: int
+    cached: int
+    duplicates: int
+    items: list[TaskStatus]
+
+def create_task(source_url: Optional[str] = None) -> str:
+    """创建任务记录并初始化日志"""
+    task_id = str(uuid.uuid4())
+    tasks[task_id] = {
+        'task_id': task_id,
+        'status': 'pending',
+        'progress': 0,
+        'message': '任务已创建，等待处理...',
+        'title': None,
+        'vocal_url': None,
+        'instrumental_url': None,
+        'lyrics': None,
+        'duration': None,
+        'source_url': source_url,
+        'downloaded': False
+    }
+    task_logs[task_id] = []
+    return task_id
+
+def is_youtube_url(url: str) -> bool:
+    """检查是否为 YouTube 链接"""
+    return bool(url) and ('youtube.com' in url or 'youtu.be' in url)
+
+def is_playlist_url(url: str) -> bool:
+    """检查是否为 YouTube 播放列表链接"""
+    return 'list=' in url or '/playlist' in url
 
 def add_task_log(task_id: str, message: str):
     """添加任务日志"""
@@ -70,49 +273,354 @@ def add_task_log(task_id: str, message: str):
     task_logs[task_id].append(message)
     logger.info(f"[{task_id}] {message}")
 
+def youtube_video_id(youtube_url: str) -> Optional[str]:
+    """从各种写法的 YouTube 链接中提取视频ID"""
+    match = re.search(r'(?:v=|youtu\.be/|/shorts/|/embed/)([\w-]{11})', youtube_url)
+    return match.group(1) if match else None
+
+def canonical_youtube_url(youtube_url: str) -> str:
+    """同一视频的不同链接写法统一为 watch?v=<视频ID>，无法识别视频ID时原样返回"""
+    video_id = youtube_video_id(youtube_url)
+    return f"https://www.youtube.com/watch?v={video_id}" if video_id else youtube_url
+
 def get_cache_key(youtube_url: str) -> str:
-    """生成 YouTube URL 的缓存键"""
-    return hashlib.md5(youtube_url.encode()).hexdigest()
+    """生成 YouTube URL 的缓存键（同一视频的不同链接写法共用一个键）"""
+    return hashlib.md5(canonical_youtube_url(youtube_url).encode()).hexdigest()
 
-def check_cache(youtube_url: str) -> Optional[dict]:
-    """检查 YouTube URL 是否已经处理过并缓存"""
-    cache_key = get_cache_key(youtube_url)
-    cache_path = CACHE_DIR / cache_key
+def canonical_song_id(youtube_url: str) -> str:
+    """同一视频的不同链接写法归为同一首歌（优先使用视频ID）"""
+    return youtube_video_id(youtube_url) or get_cache_key(youtube_url)
 
-    if cache_path.exists():
-        vocal_file = cache_path / "vocals.wav"
-        instrumental_file = cache_path / "no_vocals.wav"
-        metadata_file = cache_path / "metadata.json"
+def load_popularity():
+    """从磁盘加载歌曲热度统计"""
+    if not POPULARITY_FILE.exists():
+        return
+    try:
+        with open(POPULARITY_FILE, 'r', encoding='utf-8') as f:
+            song_popularity.update(json.load(f))
+    except Exception as e:
+        logger.warning(f"读取热度统计失败: {e}")
 
-        if vocal_file.exists() and instrumental_file.exists():
-            logger.info(f"缓存命中: {youtube_url} -> {cache_key}")
-            metadata = {}
-            if metadata_file.exists():
-                try:
-                    with open(metadata_file, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                except Exception as e:
-                    logger.warning(f"读取元数据失败: {e}")
+def save_popularity():
+    """把歌曲热度统计写回磁盘"""
+    global popularity_dirty
+    try:
+        tmp_file = META_DIR / f"popularity.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(song_popularity, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, POPULARITY_FILE)
+        popularity_dirty = False
+    except Exception as e:
+        logger.warning(f"保存热度统计失败: {e}")
+
+def record_popularity(youtube_url: str, event: str, title: Optional[str] = None):
+    """记录一次歌曲请求事件：submissions、cache_hits 或 downloads"""
+    global popularity_dirty
+    song_id = canonical_song_id(youtube_url)
+    stats = song_popularity.setdefault(song_id, {
+        'url': youtube_url,
+        'title': None,
+        'submissions': 0,
+        'cache_hits': 0,
+        'downloads': 0,
+        'last_requested': None
+    })
+    stats[event] += 1
+    stats['last_requested'] = time.time()
+    if title:
+        stats['title'] = title
+    popularity_dirty = True
+
+def update_popularity_title(youtube_url: str, title: str):
+    """补充热度统计中的歌曲标题"""
+    global popularity_dirty
+    stats = song_popularity.get(canonical_song_id(youtube_url))
+    if stats is not None and title and stats['title'] != title:
+        stats['title'] = title
+        popularity_dirty = True
+
+def popularity_score(stats: dict) -> int:
+    """热度分数：提交次数 + 下载次数（缓存命中已计入提交）"""
+    return stats['submissions'] + stats['downloads']
+
+class DirectoryCacheBackend:
+    """目录缓存后端：<root>/<cache_key>/ 下保存 vocals.wav、no_vocals.wav 和 metadata.json
+
+    条目先写入 <root>/.staging/ 再整体 rename 发布，读取方不会看到半成品；
+    <root>/.locks/ 下的租约文件保证同一缓存键同时只有一个进程在计算。
+    """
 
-            return {
-                'vocals': str(vocal_file),
-                'instrumental': str(instrumental_file),
-                'title': metadata.get('title', 'Cached Audio'),
-                'cached': True
-            }
+    STAGING_MAX_AGE_SECONDS = 86400
 
-    return None
+    def __init__(self, root: Path, lease_seconds: int = CACHE_LEASE_SECONDS):
+        self.root = Path(root)
+        self.staging_root = self.root / ".staging"
+        self.lock_root = self.root / ".locks"
+        self.lease_seconds = lease_seconds
+        for path in (self.root, self.staging_root, self.lock_root):
+            path.mkdir(parents=True, exist_ok=True)
+        self.cleanup_staging()
+
+    def entry_dir(self, cache_key: str) -> Path:
+        return self.root / cache_key
+
+    def staging_dir(self, cache_key: str) -> Path:
+        """返回新的暂存目录（不创建），写完后通过 publish 发布"""
+        return self.staging_root / f"{cache_key}.{uuid.uuid4().hex}"
+
+    def contains(self, cache_key: str) -> bool:
+        entry = self.entry_dir(cache_key)
+        return (entry / "vocals.wav").exists() and (entry / "no_vocals.wav").exists()
+
+    def get(self, cache_key: str) -> Optional[dict]:
+        """读取本目录中的缓存条目，不完整时返回 None"""
+        if not DirectoryCacheBackend.contains(self, cache_key):
+            return None
+
+        entry = self.entry_dir(cache_key)
+        metadata = self.read_metadata(cache_key) or {}
+
+        return {
+            'vocals': str(entry / "vocals.wav"),
+            'instrumental': str(entry / "no_vocals.wav"),
+            'title': metadata.get('title', 'Cached Audio'),
+            'metadata': metadata,
+            'cached': True
+        }
+
+    def read_metadata(self, cache_key: str) -> Optional[dict]:
+        """读取条目的 metadata.json，不存在或损坏时返回 None"""
+        metadata_file = self.entry_dir(cache_key) / "metadata.json"
+        if not metadata_file.exists():
+            return None
+        try:
+            with open(metadata_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"读取元数据失败: {e}")
+            return None
+
+    def publish(self, cache_key: str, vocal_file: str, instrumental_file: str, metadata: dict) -> Optional[dict]:
+        """原子发布缓存条目；音轨已在本后端暂存目录中时直接 rename，不再复制
+
+        暂存、检查和读取都固定使用本目录（子类可能把 staging_dir 等重定向到其他层），
+        保证暂存目录与目标在同一文件系统上，rename 才是原子的。
+        """
+        staging = Path(vocal_file).parent
+        in_staging = (
+            staging.parent.resolve() == self.staging_root.resolve()
+            and staging.name.startswith(cache_key)
+            and Path(vocal_file).name == "vocals.wav"
+            and Path(instrumental_file) == staging / "no_vocals.wav"
+        )
+        if not in_staging:
+            staging = DirectoryCacheBackend.staging_dir(self, cache_key)
+            staging.mkdir(parents=True)
+            shutil.copy2(vocal_file, staging / "vocals.wav")
+            shutil.copy2(instrumental_file, staging / "no_vocals.wav")
+
+        with open(staging / "metadata.json", 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+        target = self.entry_dir(cache_key)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            if DirectoryCacheBackend.contains(self, cache_key):
+                # 其他进程已发布同一条目，保留先发布的版本
+                shutil.rmtree(staging, ignore_errors=True)
+            else:
+                # 旧条目残缺，替换之
+                shutil.rmtree(target, ignore_errors=True)
+                os.rename(staging, target)
+        return DirectoryCacheBackend.get(self, cache_key)
+
+    def delete(self, cache_key: str) -> bool:
+        entry = self.entry_dir(cache_key)
+        if not entry.is_dir() or cache_key.startswith('.'):
+            return False
+        shutil.rmtree(entry)
+        return True
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def entries(self) -> list[Path]:
+        """所有缓存条目目录（跳过暂存和租约目录）"""
+        if not self.root.exists():
+            return []
+        return [p for p in self.root.iterdir() if p.is_dir() and not p.name.startswith('.')]
+
+    def cleanup_staging(self):
+        """清理中断任务遗留的暂存目录"""
+        cutoff = time.time() - self.STAGING_MAX_AGE_SECONDS
+        for path in self.staging_root.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def lease_file(self, cache_key: str) -> Path:
+        return self.lock_root / f"{cache_key}.lock"
+
+    def read_lease(self, cache_key: str) -> Optional[dict]:
+        try:
+            with open(self.lease_file(cache_key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, cache_key: str, owner: str) -> bool:
+        """尝试获取计算租约；已持有时续期并返回 True"""
+        path = self.lease_file(cache_key)
+        lease = {'owner': owner, 'expires_at': time.time() + self.lease_seconds}
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(lease, f)
+            return True
+        except FileExistsError:
+            pass
+
+        current = self.read_lease(cache_key)
+        if current is None:
+            # 租约文件可能刚创建尚未写完，按修改时间判断是否遗留
+            try:
+                if time.time() - path.stat().st_mtime < self.lease_seconds:
+                    return False
+            except FileNotFoundError:
+                return self.acquire(cache_key, owner)
+        elif current.get('owner') != owner and current.get('expires_at', 0) > time.time():
+            return False
+
+        # 续期自己的租约，或接管已过期的租约
+        tmp_file = self.lock_root / f"{cache_key}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(lease, f)
+        os.replace(tmp_file, path)
+        return (self.read_lease(cache_key) or {}).get('owner') == owner
+
+    def release(self, cache_key: str, owner: str):
+        """释放自己持有的租约"""
+        current = self.read_lease(cache_key)
+        if current is not None and current.get('owner') == owner:
+            try:
+                self.lease_file(cache_key).unlink()
+            except FileNotFoundError:
+                pass
+
+class SharedCacheBackend(DirectoryCacheBackend):
+    """多节点共享缓存：共享目录为权威存储，本地目录为读穿透层
+
+    租约文件放在共享目录中，同一首歌只有一个节点计算，其他节点等待或轮询结果。
+    每次读取都核对共享条目：任一节点删除或替换条目后，其他节点的本地副本随之失效。
+    发布到共享目录失败的条目带有 UNPUBLISHED_MARKER，本节点继续使用并在之后读取时重试发布。
+    """
+
+    UNPUBLISHED_MARKER = ".unpublished"
+
+    def __init__(self, shared_root: Path, local_root: Path, lease_seconds: int = CACHE_LEASE_SECONDS):
+        super().__init__(shared_root, lease_seconds)
+        self.local = DirectoryCacheBackend(local_root, lease_seconds)
+
+    def staging_dir(self, cache_key: str) -> Path:
+        # 分离结果在本地暂存，发布到本地层时只需 rename
+        return self.local.staging_dir(cache_key)
+
+    def contains(self, cache_key: str) -> bool:
+        # 只认共享目录和尚未发布成功的本地条目，本地残留的副本不算命中
+        return super().contains(cache_key) or self.is_unpublished(cache_key)
+
+    def is_unpublished(self, cache_key: str) -> bool:
+        """本地条目完整，但之前发布到共享目录失败"""
+        return (self.local.contains(cache_key)
+                and (self.local.entry_dir(cache_key) / self.UNPUBLISHED_MARKER).exists())
+
+    def publish_shared(self, cache_key: str, cached: dict, metadata: dict) -> bool:
+        """把本地条目复制到共享目录下的 .staging/ 再 rename（共享目录通常是另一个文件系统）"""
+        marker = self.local.entry_dir(cache_key) / self.UNPUBLISHED_MARKER
+        try:
+            super().publish(cache_key, cached['vocals'], cached['instrumental'], metadata)
+        except Exception as e:
+            # 共享目录不可用（如 NFS 挂载断开）时，本节点仍使用本地层的结果，之后重试
+            logger.error(f"发布到共享缓存失败: {e}")
+            marker.touch()
+            return False
+        marker.unlink(missing_ok=True)
+        return True
+
+    def drop_local(self, cache_key: str):
+        """删除已失效的本地副本"""
+        try:
+            self.local.delete(cache_key)
+        except OSError as e:
+            logger.warning(f"清理本地缓存副本失败: {e}")
+
+    def get(self, cache_key: str) -> Optional[dict]:
+        shared = super().get(cache_key)
+        if shared is None:
+            if self.is_unpublished(cache_key):
+                cached = self.local.get(cache_key)
+                self.publish_shared(cache_key, cached, cached['metadata'])
+                return cached
+            # 条目已被删除（可能由其他节点删除）
+            self.drop_local(cache_key)
+            return None
+
+        # 本地副本与共享条目的元数据一致才使用，音频读取走本地磁盘
+        cached = self.local.get(cache_key)
+        if cached is not None:
+            if cached['metadata'] == shared['metadata']:
+                return cached
+            self.drop_local(cache_key)
+
+        # 从共享目录拉取到本地层，之后的读取都走本地磁盘
+        try:
+            return self.local.publish(
+                cache_key, shared['vocals'], shared['instrumental'], shared['metadata']
+            ) or shared
+        except Exception as e:
+            logger.warning(f"拉取共享缓存到本地失败: {e}")
+            return shared
+
+    def publish(self, cache_key: str, vocal_file: str, instrumental_file: str, metadata: dict) -> Optional[dict]:
+        cached = self.local.publish(cache_key, vocal_file, instrumental_file, metadata)
+        self.publish_shared(cache_key, cached, metadata)
+        return cached
+
+    def delete(self, cache_key: str) -> bool:
+        deleted_local = self.local.delete(cache_key)
+        return super().delete(cache_key) or deleted_local
 
-def save_to_cache(youtube_url: str, vocal_file: str, instrumental_file: str, title: str = "Unknown"):
-    """保存处理结果到缓存"""
+    def clear(self):
+        self.local.clear()
+        super().clear()
+
+def create_cache_backend() -> DirectoryCacheBackend:
+    """按配置创建缓存后端"""
+    if CACHE_BACKEND == 'shared':
+        if not SHARED_CACHE_DIR:
+            raise RuntimeError("KARAOKE_CACHE_BACKEND=shared 需要设置 KARAOKE_SHARED_CACHE_DIR")
+        logger.info(f"使用共享缓存: {SHARED_CACHE_DIR} (本地层: {CACHE_DIR})")
+        return SharedCacheBackend(Path(SHARED_CACHE_DIR), CACHE_DIR)
+    return DirectoryCacheBackend(CACHE_DIR)
+
+cache_backend = create_cache_backend()
+
+def check_cache(youtube_url: str) -> Optional[dict]:
+    """检查 YouTube URL 是否已经处理过并缓存"""
+    cache_key = get_cache_key(youtube_url)
+    cached = cache_backend.get(cache_key)
+    if cached is not None:
+        logger.info(f"缓存命中: {youtube_url} -> {cache_key}")
+    return cached
+
+def save_to_cache(youtube_url: str, vocal_file: str, instrumental_file: str, title: str = "Unknown") -> Optional[dict]:
+    """保存处理结果到缓存，成功时返回缓存项（同 check_cache）"""
     try:
         cache_key = get_cache_key(youtube_url)
-        cache_path = CACHE_DIR / cache_key
-        cache_path.mkdir(exist_ok=True)
-
-        # 复制文件到缓存目录
-        shutil.copy2(vocal_file, cache_path / "vocals.wav")
-        shutil.copy2(instrumental_file, cache_path / "no_vocals.wav")
 
         # 保存元数据
         metadata = {
@@ -121,15 +629,15 @@ def save_to_cache(youtube_url: str, vocal_file: str, instrumental_file: str, tit
             'cached_at': str(Path(vocal_file).stat().st_mtime)
         }
 
-        with open(cache_path / "metadata.json", 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-
+        cached = cache_backend.publish(cache_key, vocal_file, instrumental_file, metadata)
         logger.info(f"已保存到缓存: {youtube_url} -> {cache_key}")
+        return cached
     except Exception as e:
         logger.error(f"保存缓存失败: {e}")
+        return None
 
-def detect_gpu_support() -> tuple[bool, str]:
-    """检测 GPU 支持"""
+def probe_gpu_device() -> tuple[bool, str]:
+    """检测 GPU 支持（会导入 torch，只在探测能力时调用）"""
     try:
         import torch
         if torch.cuda.is_available():
@@ -143,8 +651,226 @@ def detect_gpu_support() -> tuple[bool, str]:
         logger.info("PyTorch 未安装, 使用 CPU")
         return False, "cpu"
 
-def download_youtube_audio(url: str, output_path: str) -> str:
-    """下载YouTube音频"""
+def locate_ffmpeg() -> Optional[str]:
+    """查找 ffmpeg：优先 imageio-ffmpeg 自带的二进制，否则使用系统 ffmpeg"""
+    try:
+        from imageio_ffmpeg import get_ffmpeg_exe
+        ffmpeg_exe = get_ffmpeg_exe()
+        if Path(ffmpeg_exe).exists():
+            return ffmpeg_exe
+    except Exception as e:
+        logger.warning(f"imageio-ffmpeg 获取失败: {e}")
+    return shutil.which('ffmpeg')
+
+def torch_checkpoint_dir() -> Path:
+    """torch hub 的权重目录（与 torch.hub.get_dir() 规则一致，无需导入 torch）"""
+    torch_home = os.environ.get('TORCH_HOME') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'torch')
+    return Path(torch_home) / "hub" / "checkpoints"
+
+def probe_model_files() -> dict:
+    """检查模型权重是否已在本地（不加载模型）"""
+    checkpoint_dir = torch_checkpoint_dir()
+    checkpoints = sorted(f.name for f in checkpoint_dir.glob('*.th')) if checkpoint_dir.is_dir() else []
+
+    validated = None
+    if MODELS_READY_FILE.exists():
+        try:
+            with open(MODELS_READY_FILE, 'r', encoding='utf-8') as f:
+                validated = json.load(f)
+        except Exception as e:
+            logger.warning(f"读取模型校验记录失败: {e}")
+
+    spleeter_dir = Path(os.environ.get('MODEL_PATH', 'pretrained_models')) / "2stems"
+    return {
+        'demucs_model': DEMUCS_MODEL,
+        'demucs_checkpoint_dir': str(checkpoint_dir),
+        'demucs_checkpoints': checkpoints,
+        'demucs_validated': bool(validated and validated.get('demucs') == DEMUCS_MODEL),
+        'spleeter_model_present': spleeter_dir.is_dir() and any(spleeter_dir.iterdir()),
+        'validated_at': validated.get('validated_at') if validated else None,
+    }
+
+def probe_capabilities(refresh: bool = False) -> dict:
+    """探测运行环境能力并缓存；refresh=True 时重新探测
+
+    torch 导入、ffmpeg 查找等较慢的检查只在这里做，分离和 /health 都读缓存结果。
+    """
+    global capabilities
+    with capabilities_lock:
+        if capabilities and not refresh:
+            return capabilities
+
+        started = time.perf_counter()
+        has_gpu, device = probe_gpu_device()
+        ffmpeg_path = locate_ffmpeg()
+        engines = {
+            'demucs': shutil.which('demucs') is not None,
+            'spleeter': importlib.util.find_spec('spleeter') is not None,
+            'ffmpeg': ffmpeg_path is not None,
+        }
+
+        capabilities = {
+            'platform': platform.system(),
+            'gpu_available': has_gpu,
+            'device': device,
+            'ffmpeg_path': ffmpeg_path,
+            'engines': engines,
+            'models': probe_model_files(),
+            'probed_at': time.time(),
+            'probe_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+        logger.info(f"能力探测完成: 设备 {device}, 引擎 {engines}, 耗时 {capabilities['probe_ms']} ms")
+        return capabilities
+
+def detect_gpu_support() -> tuple[bool, str]:
+    """返回缓存的 GPU 检测结果"""
+    caps = probe_capabilities()
+    return caps['gpu_available'], caps['device']
+
+def preload_models() -> dict:
+    """下载并校验模型权重（加载一次即可确认权重完整可用）"""
+    result = {'demucs': None, 'spleeter': None}
+    started = time.perf_counter()
+
+    try:
+        from demucs.pretrained import get_model
+        logger.info(f"预加载 Demucs 模型: {DEMUCS_MODEL}")
+        get_model(DEMUCS_MODEL)
+        result['demucs'] = 'ok'
+    except Exception as e:
+        logger.error(f"Demucs 模型预加载失败: {e}")
+        result['demucs'] = f'error: {e}'
+
+    if importlib.util.find_spec('spleeter') is not None:
+        try:
+            # 对一秒静音推理一次，触发权重下载和 TensorFlow 图构建，之后常驻复用
+            with spleeter_lock:
+                get_spleeter_separator().separate(np.zeros((SPLEETER_SAMPLE_RATE, 2), dtype=np.float32))
+            result['spleeter'] = 'ok'
+        except Exception as e:
+            logger.error(f"Spleeter 模型预加载失败: {e}")
+            result['spleeter'] = f'error: {e}'
+
+    if result['demucs'] == 'ok':
+        try:
+            tmp_file = META_DIR / f"models_ready.{uuid.uuid4().hex}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'demucs': DEMUCS_MODEL, 'validated_at': time.time()}, f)
+            os.replace(tmp_file, MODELS_READY_FILE)
+        except Exception as e:
+            logger.warning(f"保存模型校验记录失败: {e}")
+
+    result['seconds'] = round(time.perf_counter() - started, 2)
+    return result
+
+def load_video_metadata(youtube_url: str) -> Optional[dict]:
+    """从内存或磁盘读取已缓存的视频元数据"""
+    cache_key = get_cache_key(youtube_url)
+    if cache_key in video_metadata:
+        return video_metadata[cache_key]
+
+    meta_file = META_DIR / f"{cache_key}.json"
+    if meta_file.exists():
+        try:
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            video_metadata[cache_key] = metadata
+            return metadata
+        except Exception as e:
+            logger.warning(f"读取视频元数据失败: {e}")
+    return None
+
+def store_video_metadata(youtube_url: str, metadata: dict):
+    """把视频元数据写入内存和磁盘"""
+    cache_key = get_cache_key(youtube_url)
+    video_metadata[cache_key] = metadata
+    try:
+        meta_file = META_DIR / f"{cache_key}.json"
+        tmp_file = META_DIR / f"{cache_key}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, meta_file)
+    except Exception as e:
+        logger.warning(f"保存视频元数据失败: {e}")
+
+def fetch_video_metadata(youtube_url: str) -> dict:
+    """获取视频元数据（标题、时长、视频ID、可用音频格式），优先使用缓存
+
+    播放列表预填的条目没有音频格式（audio_formats 为 None），视为不完整，首次使用时重新查询。
+    """
+    cached = load_video_metadata(youtube_url)
+    if cached is not None and cached.get('duration') is not None and cached.get('audio_formats') is not None:
+        return cached
+
+    ydl_opts = {
+        'skip_download': True,
+        'noplaylist': True,
+        'quiet': True,
+        'no_warnings': True,
+    }
+
+    import yt_dlp
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        logger.info(f"获取元数据: {youtube_url}")
+        info = ydl.extract_info(youtube_url, download=False)
+
+    audio_formats = [
+        {
+            'format_id': fmt.get('format_id'),
+            'ext': fmt.get('ext'),
+            'acodec': fmt.get('acodec'),
+            'abr': fmt.get('abr'),
+            'filesize': fmt.get('filesize') or fmt.get('filesize_approx'),
+        }
+        for fmt in info.get('formats') or []
+        if fmt.get('acodec') not in (None, 'none') and fmt.get('vcodec') in (None, 'none')
+    ]
+
+    metadata = {
+        'url': youtube_url,
+        'video_id': info.get('id'),
+        'title': info.get('title') or 'Unknown',
+        'duration': info.get('duration'),
+        'audio_formats': audio_formats,
+        'fetched_at': time.time()
+    }
+    store_video_metadata(youtube_url, metadata)
+    return metadata
+
+def seed_video_metadata(youtube_url: str, entry: dict):
+    """用播放列表条目中的标题和时长预填元数据缓存（不含音频格式）"""
+    if entry.get('duration') is None or load_video_metadata(youtube_url) is not None:
+        return
+    store_video_metadata(youtube_url, {
+        'url': youtube_url,
+        'video_id': entry.get('id'),
+        'title': entry.get('title') or 'Unknown',
+        'duration': entry.get('duration'),
+        'audio_formats': None,
+        'fetched_at': time.time()
+    })
+
+def estimate_job_cost(duration: Optional[float]) -> float:
+    """按歌曲时长估算处理开销（下载与分离耗时都与时长近似成正比）"""
+    return float(duration if duration is not None else DEFAULT_DURATION_SECONDS)
+
+def download_youtube_audio(url: str, output_path: str, cancel_event: Optional[threading.Event] = None) -> str:
+    """下载YouTube音频（cancel_event 被设置时中止下载，超长歌曲在下载前拒绝）"""
+    def check_cancelled(progress):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled("下载已中止，让出资源")
+
+    # 元数据查询失败时也要在下载前检查时长：yt-dlp 解析信息后、下载任何数据前调用
+    rejected = []
+
+    def check_duration(info, *, incomplete=False):
+        duration = info.get('duration')
+        if duration is not None and duration > MAX_DURATION_SECONDS:
+            rejected.append(f"歌曲时长 {int(duration)} 秒超过上限 {MAX_DURATION_SECONDS} 秒")
+            return rejected[-1]
+        return None
+
     ydl_opts = {
         'format': 'bestaudio/best',
         'postprocessors': [{
@@ -153,21 +879,51 @@ def download_youtube_audio(url: str, output_path: str) -> str:
             'preferredquality': '192',
         }],
         'outtmpl': output_path,
+        'progress_hooks': [check_cancelled],
+        'match_filter': check_duration,
         'quiet': True,
         'no_warnings': True,
     }
     
     try:
+        import yt_dlp
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             logger.info(f"开始下载: {url}")
             ydl.download([url])
-            # 返回实际的mp3文件路径
-            return output_path + '.mp3'
+        if rejected:
+            raise Exception(rejected[0])
+        # 返回实际的mp3文件路径
+        return output_path + '.mp3'
     except Exception as e:
+        # yt-dlp 可能把回调中的异常包装成 DownloadError
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled("下载已中止，让出资源")
         logger.error(f"下载失败: {str(e)}")
         raise
 
-def separate_audio_demucs(input_file: str, output_dir: str, use_gpu: bool = None) -> dict:
+def run_cancellable(cmd: list, timeout: int, cancel_event: Optional[threading.Event] = None) -> subprocess.CompletedProcess:
+    """运行子进程；cancel_event 被设置时立即终止进程并抛出 JobCancelled"""
+    if cancel_event is None:
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+    deadline = time.monotonic() + timeout
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=0.5)
+                return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+            except subprocess.TimeoutExpired:
+                if cancel_event.is_set():
+                    proc.kill()
+                    proc.communicate()
+                    raise JobCancelled("分离已中止，让出资源")
+                if time.monotonic() > deadline:
+                    proc.kill()
+                    proc.communicate()
+                    raise
+
+def separate_audio_demucs(input_file: str, output_dir: str, use_gpu: bool = None,
+                          cancel_event: Optional[threading.Event] = None) -> dict:
     """使用Demucs分离音轨 (优化版)"""
     try:
         logger.info(f"开始分离音轨: {input_file}")
@@ -183,21 +939,21 @@ def separate_audio_demucs(input_file: str, output_dir: str, use_gpu: bool = None
         cmd = [
             'demucs',
             '--two-stems=vocals',  # 只分离人声和伴奏
-            '-n', 'htdemucs_ft',  # 使用 fine-tuned 模型 (更快更准)
+            '-n', DEMUCS_MODEL,  # 使用 fine-tuned 模型 (更快更准)
             '--device', device,  # GPU 或 CPU
             '-o', output_dir,
             input_file
         ]
 
         logger.info(f"使用设备: {device} {'(GPU加速)' if has_gpu else '(CPU)'}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+        result = run_cancellable(cmd, 600, cancel_event)
         
         if result.returncode != 0:
             raise Exception(f"Demucs分离失败: {result.stderr}")
         
-        # Demucs输出结构: output_dir/htdemucs/filename/vocals.wav 和 no_vocals.wav
+        # Demucs输出结构: output_dir/<模型名>/filename/vocals.wav 和 no_vocals.wav
         filename = Path(input_file).stem
-        base_path = Path(output_dir) / "htdemucs" / filename
+        base_path = Path(output_dir) / DEMUCS_MODEL / filename
 
         return {
             'vocals': str(base_path / "vocals.wav"),
@@ -211,29 +967,60 @@ def separate_audio_demucs(input_file: str, output_dir: str, use_gpu: bool = None
         logger.error(f"音轨分离失败: {str(e)}")
         raise
 
+def get_spleeter_separator():
+    """返回常驻的 Spleeter 实例（首次调用时加载模型）"""
+    global spleeter_separator
+    with spleeter_lock:
+        if spleeter_separator is None:
+            # 安装: pip install spleeter
+            from spleeter.separator import Separator
+            logger.info("加载 Spleeter 模型（常驻内存）")
+            spleeter_separator = Separator('spleeter:2stems', multiprocess=False)
+        return spleeter_separator
+
+def separate_batch_spleeter(input_files: list[str], output_dirs: list[str]) -> list[dict]:
+    """用常驻 Spleeter 批量分离：解码后的 PCM 拼接成一段一次推理，再按位置切回各首歌
+
+    音轨直接写入 output_dirs（通常是最终缓存目录），不产生中间文件。
+    """
+    gap = np.zeros((SPLEETER_SAMPLE_RATE, 2), dtype=np.float32)
+    pieces = []
+    spans = []
+    position = 0
+    for input_file in input_files:
+        waveform = decode_audio_pcm(input_file, SPLEETER_SAMPLE_RATE)
+        spans.append((position, position + len(waveform)))
+        pieces.extend([waveform, gap])
+        position += len(waveform) + len(gap)
+
+    with spleeter_lock:
+        prediction = get_spleeter_separator().separate(np.concatenate(pieces))
+
+    results = []
+    for (start, end), output_dir in zip(spans, output_dirs):
+        out_dir = Path(output_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        vocal_file = out_dir / "vocals.wav"
+        instrumental_file = out_dir / "no_vocals.wav"
+        write_wav_pcm16(str(instrumental_file), prediction['accompaniment'][start:end], SPLEETER_SAMPLE_RATE)
+        write_wav_pcm16(str(vocal_file), prediction['vocals'][start:end], SPLEETER_SAMPLE_RATE)
+        results.append({'vocals': str(vocal_file), 'instrumental': str(instrumental_file)})
+    return results
+
 def separate_audio_spleeter(input_file: str, output_dir: str) -> dict:
-    """使用Spleeter分离音轨（备选方案）"""
+    """使用Spleeter分离音轨（备选方案，复用常驻模型）"""
     try:
         logger.info(f"使用Spleeter分离: {input_file}")
-        
-        # 安装: pip install spleeter
-        from spleeter.separator import Separator
-        
-        separator = Separator('spleeter:2stems')
-        separator.separate_to_file(input_file, output_dir)
-        
-        filename = Path(input_file).stem
-        base_path = Path(output_dir) / filename
-        
-        return {
-            'vocals': str(base_path / "vocals.wav"),
-            'instrumental': str(base_path / "accompaniment.wav")
-        }
+        return separate_batch_spleeter([input_file], [output_dir])[0]
     except Exception as e:
         logger.error(f"Spleeter分离失败: {str(e)}")
         raise
 
 
+def find_ffmpeg_exe() -> str:
+    """返回探测时缓存的 ffmpeg 路径（未找到时交给 PATH 解析）"""
+    return probe_capabilities().get('ffmpeg_path') or 'ffmpeg'
+
 def separate_audio_simple_ffmpeg(input_file: str, output_dir: str) -> dict:
     """使用 ffmpeg 做简单的声道中间声道消除（center-channel cancellation），仅生成伴奏（instrumental）。
     这是一种轻量、近似的去人声方法，效果有限但快速。
@@ -241,15 +1028,7 @@ def separate_audio_simple_ffmpeg(input_file: str, output_dir: str) -> dict:
     """
     try:
         logger.info(f"尝试简单 ffmpeg 分离: {input_file}")
-        # 尝试获取 imageio-ffmpeg 的 ffmpeg 二进制
-        ffmpeg_exe = None
-        try:
-            from imageio_ffmpeg import get_ffmpeg_exe
-            ffmpeg_exe = get_ffmpeg_exe()
-            logger.info(f"使用 imageio-ffmpeg: {ffmpeg_exe}")
-        except Exception as e:
-            logger.warning(f"imageio-ffmpeg 获取失败: {e}")
-            ffmpeg_exe = 'ffmpeg'  # fallback to system ffmpeg
+        ffmpeg_exe = find_ffmpeg_exe()
 
         out_inst = str(Path(output_dir) / 'instrumental.mp3')
 
@@ -277,177 +1056,944 @@ def separate_audio_simple_ffmpeg(input_file: str, output_dir: str) -> dict:
         logger.error(f"简单 ffmpeg 分离失败: {str(e)}")
         raise
 
+def decode_audio_pcm(input_file: str, sample_rate: int = RENDITION_SAMPLE_RATE) -> np.ndarray:
+    """用 ffmpeg 把音频解码为 float32 立体声 PCM，形状为 (samples, 2)"""
+    cmd = [
+        find_ffmpeg_exe(),
+        '-v', 'error',
+        '-i', input_file,
+        '-f', 'f32le',
+        '-acodec', 'pcm_f32le',
+        '-ac', '2',
+        '-ar', str(sample_rate),
+        '-'
+    ]
+    result = subprocess.run(cmd, capture_output=True, timeout=120)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg 解码失败: {result.stderr.decode(errors='ignore')}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, 2)
+
+def write_wav_pcm16(output_file: str, samples: np.ndarray, sample_rate: int = RENDITION_SAMPLE_RATE):
+    """把 float PCM (samples, channels) 写为 16 位 WAV
+
+    先写临时文件再替换，避免并发读取到半成品。
+    """
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+    tmp_file = Path(output_file).with_name(f"{Path(output_file).stem}.{uuid.uuid4().hex}.tmp")
+    with wave.open(str(tmp_file), 'wb') as wf:
+        wf.setnchannels(pcm.shape[1])
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(pcm.tobytes())
+    os.replace(tmp_file, output_file)
+
+def phase_vocoder_stretch(signal: np.ndarray, stretch: float) -> np.ndarray:
+    """相位声码器时间伸缩（单声道）：stretch > 1 变慢，音高不变
+
+    按帧块向量化计算 STFT、相位累加和重叠相加，避免一次性生成整首歌的频谱矩阵；
+    输入和输出波形仍完整保存在内存中（与歌曲长度成正比）。
+    """
+    n_fft, hop = RENDITION_N_FFT, RENDITION_HOP
+    window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+    padded = np.pad(signal, (n_fft // 2, n_fft + n_fft // 2))
+    frames = sliding_window_view(padded, n_fft)[::hop]
+
+    # 输出第 i 帧对应输入的（小数）帧位置
+    time_steps = np.arange(0, frames.shape[0] - 1, 1.0 / stretch)
+    phase_advance = 2 * np.pi * hop * np.arange(n_fft // 2 + 1) / n_fft
+    output = np.zeros(len(time_steps) * hop + n_fft, dtype=np.float32)
+    phase = None
+
+    for start in range(0, len(time_steps), RENDITION_BLOCK_FRAMES):
+        steps = time_steps[start:start + RENDITION_BLOCK_FRAMES]
+        idx = steps.astype(np.int64)
+        alpha = (steps - idx)[:, None]
+
+        first = idx[0]
+        spec = np.fft.rfft(frames[first:idx[-1] + 2] * window, axis=1)
+        left = spec[idx - first]
+        right = spec[idx - first + 1]
+
+        # 幅度线性插值，相位按实际频率累加
+        magnitude = (1 - alpha) * np.abs(left) + alpha * np.abs(right)
+        delta = np.angle(right) - np.angle(left) - phase_advance
+        delta -= 2 * np.pi * np.round(delta / (2 * np.pi))
+        increments = phase_advance + delta
+
+        if phase is None:
+            phase = np.angle(left[0])
+        accumulated = phase + np.concatenate(
+            [np.zeros((1, increments.shape[1])), np.cumsum(increments[:-1], axis=0)]
+        )
+        phase = accumulated[-1] + increments[-1]
+
+        # 逆变换并重叠相加
+        synthesized = np.fft.irfft(magnitude * np.exp(1j * accumulated), n=n_fft, axis=1) * window
+        segments = synthesized.reshape(len(steps), n_fft // hop, hop)
+        base = start * hop
+        for k in range(n_fft // hop):
+            offset = base + k * hop
+            output[offset:offset + len(steps) * hop] += segments[:, k, :].ravel()
+
+    output /= np.sum(window ** 2) / hop
+    length = int(round(len(signal) * stretch))
+    output = output[n_fft // 2:n_fft // 2 + length]
+    return np.pad(output, (0, length - len(output)))
+
+def resample_linear(signal: np.ndarray, factor: float) -> np.ndarray:
+    """线性插值重采样：factor > 1 时缩短信号（播放时音高升高）"""
+    length = int(round(len(signal) / factor))
+    positions = np.arange(length) * factor
+    return np.interp(positions, np.arange(len(signal)), signal).astype(np.float32)
+
+def render_rendition(input_file: str, output_file: str, semitones: int, tempo: float):
+    """渲染变调/变速版本：先用相位声码器伸缩时长，再重采样改变音高"""
+    logger.info(f"渲染变调/变速版本: {input_file} ({semitones:+d} 半音, {tempo}x)")
+    samples = decode_audio_pcm(input_file)
+    ratio = 2.0 ** (semitones / 12.0)
+    stretch = ratio / tempo
+
+    channels = []
+    for ch in range(samples.shape[1]):
+        channel = samples[:, ch]
+        if abs(stretch - 1.0) > 1e-6:
+            channel = phase_vocoder_stretch(channel, stretch)
+        if semitones:
+            channel = resample_linear(channel, ratio)
+        channels.append(channel)
+
+    write_wav_pcm16(output_file, np.stack(channels, axis=1))
+
+def read_wav_layout(path: str) -> dict:
+    """解析 WAV 头，返回 PCM 数据的偏移、帧数和样本格式（用于内存映射）"""
+    with open(path, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError("不是 WAV 文件")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("WAV 文件缺少数据块")
+            chunk_id, size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                data = f.read(size + size % 2)
+                format_tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', data[:16])
+                if format_tag == 0xFFFE and size >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE：真实格式在子格式 GUID 的前两个字节
+                    format_tag = struct.unpack('<H', data[24:26])[0]
+                fmt = (format_tag, channels, sample_rate, bits)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("WAV 文件缺少 fmt 块")
+                format_tag, channels, sample_rate, bits = fmt
+                dtype, scale = {
+                    (1, 16): ('<i2', 1 / 32768),
+                    (1, 32): ('<i4', 1 / 2147483648),
+                    (3, 32): ('<f4', 1.0),
+                }.get((format_tag, bits), (None, None))
+                if dtype is None:
+                    raise ValueError(f"不支持的 WAV 格式 (format={format_tag}, bits={bits})")
+
+                offset = f.tell()
+                size = min(size, os.path.getsize(path) - offset)
+                return {
+                    'offset': offset,
+                    'frames': size // (channels * bits // 8),
+                    'channels': channels,
+                    'sample_rate': sample_rate,
+                    'dtype': dtype,
+                    'scale': scale
+                }
+            else:
+                f.seek(size + size % 2, 1)
+
+def wav_header_pcm16(frames: int, channels: int, sample_rate: int) -> bytes:
+    """生成 16 位 PCM WAV 文件头"""
+    data_size = frames * channels * 2
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+        b'data', data_size
+    )
+
+def open_guide_mix(vocal_file: str, instrumental_file: str) -> dict:
+    """内存映射人声和伴奏音轨，准备按块混音"""
+    layouts = [read_wav_layout(vocal_file), read_wav_layout(instrumental_file)]
+    if layouts[0]['sample_rate'] != layouts[1]['sample_rate']:
+        raise ValueError("人声和伴奏的采样率不一致")
+
+    frames = min(layout['frames'] for layout in layouts)
+    if frames == 0:
+        raise ValueError("音轨为空")
+    channels = max(layout['channels'] for layout in layouts)
+    stems = [
+        np.memmap(path, dtype=layout['dtype'], mode='r', offset=layout['offset'],
+                  shape=(layout['frames'], layout['channels']))
+        for path, layout in zip((vocal_file, instrumental_file), layouts)
+    ]
+    header = wav_header_pcm16(frames, channels, layouts[0]['sample_rate'])
+
+    return {
+        'vocals': stems[0],
+        'instrumental': stems[1],
+        'vocal_scale': layouts[0]['scale'],
+        'instrumental_scale': layouts[1]['scale'],
+        'frames': frames,
+        'channels': channels,
+        'header': header,
+        'total_size': len(header) + frames * channels * 2
+    }
+
+def iter_guide_mix(mix: dict, vocal_gain: float, instrumental_gain: float, start: int, end: int):
+    """逐块生成混音 WAV 中字节闭区间 [start, end] 的内容"""
+    header = mix['header']
+    if start < len(header):
+        yield header[start:min(end + 1, len(header))]
+
+    data_start = max(start - len(header), 0)
+    data_end = end - len(header)
+    if data_end < data_start:
+        return
+
+    frame_bytes = mix['channels'] * 2
+    first_frame = data_start // frame_bytes
+    last_frame = data_end // frame_bytes
+    vocal_gain *= mix['vocal_scale']
+    instrumental_gain *= mix['instrumental_scale']
+
+    for block_start in range(first_frame, last_frame + 1, MIX_BLOCK_FRAMES):
+        block_end = min(block_start + MIX_BLOCK_FRAMES, last_frame + 1)
+        mixed = (
+            mix['instrumental'][block_start:block_end].astype(np.float32) * instrumental_gain
+            + mix['vocals'][block_start:block_end].astype(np.float32) * vocal_gain
+        )
+        mixed = np.broadcast_to(mixed, (block_end - block_start, mix['channels']))
+        data = (np.clip(mixed, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+        offset = block_start * frame_bytes
+        yield data[max(data_start - offset, 0):min(data_end + 1 - offset, len(data))]
+
+def encode_guide_mix(vocal_file: str, instrumental_file: str, vocal_gain: float,
+                     instrumental_gain: float, output_file: str):
+    """把混音编码为 MP3 文件（直接把 PCM 块写入 ffmpeg，不落地中间 WAV）"""
+    mix = open_guide_mix(vocal_file, instrumental_file)
+    tmp_file = Path(output_file).with_name(f"{Path(output_file).stem}.{uuid.uuid4().hex}.tmp")
+    cmd = [
+        find_ffmpeg_exe(),
+        '-v', 'error',
+        '-y',
+        '-f', 'wav',
+        '-i', '-',
+        '-codec:a', 'libmp3lame',
+        '-q:a', '2',
+        '-f', 'mp3',
+        str(tmp_file)
+    ]
+
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        try:
+            for chunk in iter_guide_mix(mix, vocal_gain, instrumental_gain, 0, mix['total_size'] - 1):
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+        stderr = proc.stderr.read()
+        proc.wait()
+
+    if proc.returncode != 0:
+        tmp_file.unlink(missing_ok=True)
+        raise Exception(f"ffmpeg 编码失败: {stderr.decode(errors='ignore')}")
+    os.replace(tmp_file, output_file)
+
+def get_rendition_path(source_file: str, semitones: int, tempo: float) -> Path:
+    """变调/变速版本与源音轨放在同一目录，缓存项删除时一并清理"""
+    source = Path(source_file)
+    return source.parent / "renditions" / f"{source.stem}_k{semitones:+d}_t{int(round(tempo * 100))}.wav"
+
+def is_demucs_engine_failure(error: Exception) -> bool:
+    """Demucs 本身不可用（而不是某首歌处理失败）"""
+    if isinstance(error, FileNotFoundError):
+        # 找不到 demucs 命令
+        return True
+    return any(marker in str(error) for marker in DEMUCS_ENGINE_ERRORS)
+
+def record_demucs_result(error: Optional[Exception] = None):
+    """记录 Demucs 结果；引擎级故障或连续失败达到上限时进入冷却"""
+    global demucs_failed_at, demucs_consecutive_failures
+    if error is None:
+        demucs_consecutive_failures = 0
+        return
+    demucs_consecutive_failures += 1
+    if is_demucs_engine_failure(error) or demucs_consecutive_failures >= DEMUCS_MAX_CONSECUTIVE_FAILURES:
+        logger.warning(f"Demucs 暂停使用 {DEMUCS_RETRY_SECONDS} 秒（连续失败 {demucs_consecutive_failures} 次）")
+        demucs_failed_at = time.time()
+        demucs_consecutive_failures = 0
+
+def demucs_recently_failed() -> bool:
+    """Demucs 在冷却时间内失败过"""
+    return demucs_failed_at is not None and time.time() - demucs_failed_at < DEMUCS_RETRY_SECONDS
+
+def separate_with_fallback(input_file: str, output_dir: str, log,
+                           cancel_event: Optional[threading.Event] = None,
+                           stem_dir: Optional[str] = None) -> dict:
+    """依次尝试 Demucs -> Spleeter -> 简单 ffmpeg 分离，log 为日志回调
+
+    stem_dir 为 Spleeter 直接写入音轨的目录（如最终缓存目录），默认为 output_dir。
+    """
+    if demucs_recently_failed():
+        log("Demucs unavailable recently, using resident Spleeter...")
+    else:
+        try:
+            # 优先使用Demucs
+            log("Running Demucs separation...")
+            separated = separate_audio_demucs(input_file, output_dir, cancel_event=cancel_event)
+            record_demucs_result()
+            return separated
+        except JobCancelled:
+            raise
+        except Exception as e:
+            record_demucs_result(e)
+            logger.warning(f"Demucs失败，尝试Spleeter: {str(e)}")
+            log("Demucs failed, trying Spleeter...")
+    # 备用Spleeter
+    try:
+        return separate_audio_spleeter(input_file, stem_dir or output_dir)
+    except Exception as e2:
+        logger.warning(f"Spleeter 也失败，尝试简单 ffmpeg 方案: {str(e2)}")
+        log("Spleeter failed, using simple ffmpeg method...")
+    return separate_audio_simple_ffmpeg(input_file, output_dir)
+
+def complete_task_from_cache(task_id: str, cached_result: dict):
+    """用缓存结果完成任务"""
+    tasks[task_id]['status'] = 'completed'
+    tasks[task_id]['progress'] = 100
+    tasks[task_id]['message'] = '从缓存加载完成 (秒级响应)!'
+    tasks[task_id]['title'] = cached_result.get('title', 'Cached Audio')
+    tasks[task_id]['vocal_url'] = f"/download/{task_id}/vocals"
+    tasks[task_id]['instrumental_url'] = f"/download/{task_id}/instrumental"
+    tasks[task_id]['vocal_file'] = cached_result['vocals']
+    tasks[task_id]['instrumental_file'] = cached_result['instrumental']
+    add_task_log(task_id, "✓ Cache hit! Loaded instantly.")
+    logger.info(f"任务完成 (缓存): {task_id}")
+
+def complete_task(task_id: str, title: str, separated: dict):
+    """标记任务完成并写入历史记录"""
+    add_task_log(task_id, "TASK_COMPLETED")
+
+    # 更新状态：完成
+    tasks[task_id]['status'] = 'completed'
+    tasks[task_id]['progress'] = 100
+    tasks[task_id]['message'] = '处理完成！'
+    tasks[task_id]['title'] = title
+    tasks[task_id]['vocal_url'] = f"/download/{task_id}/vocals"
+    tasks[task_id]['instrumental_url'] = f"/download/{task_id}/instrumental"
+    tasks[task_id]['vocal_file'] = separated['vocals']
+    tasks[task_id]['instrumental_file'] = separated['instrumental']
+
+    # 添加到历史记录
+    history[task_id] = {
+        'title': title,
+        'date': 'recent'
+    }
+
+def fail_task(task_id: str, error: Exception):
+    """标记任务失败"""
+    logger.error(f"任务失败 {task_id}: {str(error)}")
+    tasks[task_id]['status'] = 'error'
+    tasks[task_id]['message'] = f'处理失败: {str(error)}'
+    add_task_log(task_id, f"ERROR: {str(error)}")
+
 async def process_youtube_task(task_id: str, youtube_url: str):
-    """后台任务：处理YouTube链接 (带缓存优化)"""
+    """后台任务：处理YouTube链接 (缓存命中直接完成，否则查询元数据后进入流水线)"""
     try:
         # 检查缓存
         add_task_log(task_id, "Checking cache...")
-        cached_result = check_cache(youtube_url)
+        cached_result = await asyncio.to_thread(check_cache, youtube_url)
+        record_popularity(youtube_url, 'submissions')
 
         if cached_result:
             # 缓存命中!
-            tasks[task_id]['status'] = 'completed'
-            tasks[task_id]['progress'] = 100
-            tasks[task_id]['message'] = '从缓存加载完成 (秒级响应)!'
-            tasks[task_id]['title'] = cached_result.get('title', 'Cached Audio')
-            tasks[task_id]['vocal_url'] = f"/download/{task_id}/vocals"
-            tasks[task_id]['instrumental_url'] = f"/download/{task_id}/instrumental"
-            tasks[task_id]['vocal_file'] = cached_result['vocals']
-            tasks[task_id]['instrumental_file'] = cached_result['instrumental']
-            add_task_log(task_id, "✓ Cache hit! Loaded instantly.")
-            logger.info(f"任务完成 (缓存): {task_id}")
+            record_popularity(youtube_url, 'cache_hits', cached_result.get('title'))
+            complete_task_from_cache(task_id, cached_result)
             return
 
         # 缓存未命中,开始处理
-        add_task_log(task_id, "Cache miss. Starting fresh processing...")
-
-        # 更新状态：下载中
-        tasks[task_id]['status'] = 'downloading'
-        tasks[task_id]['progress'] = 10
-        tasks[task_id]['message'] = '正在从YouTube下载音频...'
-        add_task_log(task_id, "Fetching YouTube metadata...")
-
-        # 创建任务专属目录
-        task_dir = WORK_DIR / task_id
-        task_dir.mkdir(exist_ok=True)
-
-        # 下载音频
-        add_task_log(task_id, "Downloading audio track...")
-        audio_file = download_youtube_audio(
-            youtube_url,
-            str(task_dir / "original")
+        add_task_log(task_id, "Cache miss. Fetching YouTube metadata...")
+
+        try:
+            async with metadata_semaphore:
+                metadata = await asyncio.to_thread(fetch_video_metadata, youtube_url)
+        except Exception as e:
+            # 元数据获取失败不阻塞处理：有播放列表预填的条目则沿用，否则按默认时长排队
+            # （时长由下载时的 match_filter 检查）
+            logger.warning(f"获取元数据失败 {youtube_url}: {e}")
+            metadata = await asyncio.to_thread(load_video_metadata, youtube_url) or {}
+
+        duration = metadata.get('duration')
+        tasks[task_id]['duration'] = duration
+        if metadata.get('title'):
+            tasks[task_id]['title'] = metadata['title']
+            update_popularity_title(youtube_url, metadata['title'])
+
+        # 下载前拒绝超长歌曲
+        if duration is not None and duration > MAX_DURATION_SECONDS:
+            raise Exception(f"歌曲时长 {int(duration)} 秒超过上限 {MAX_DURATION_SECONDS} 秒")
+
+        enqueue_youtube_job(task_id, youtube_url, metadata)
+
+    except Exception as e:
+        fail_task(task_id, e)
+
+async def process_upload_task(task_id: str, input_file: str, filename: str):
+    """后台任务：上传的音频文件直接进入分离阶段，与 YouTube 作业统一调度（不缓存）"""
+    try:
+        preempt_warm_jobs()
+        job = new_pipeline_job(
+            None, {'title': Path(filename).stem[:50]}, Path(input_file).parent, PRIORITY_USER,
+            cache_key=f"upload-{task_id}"
         )
-        add_task_log(task_id, "Download completed!")
+        job['task_ids'].append(task_id)
+        job['audio_file'] = input_file
+        update_job_tasks(job, 'pending', 35, '排队等待分离...')
+        add_task_log(task_id, "Queued for separation...")
+
+        # 分离阶段繁忙时在此等待
+        await separation_queue.put(job_queue_entry(job))
 
-        # 更新状态：分离中
-        tasks[task_id]['status'] = 'separating'
-        tasks[task_id]['progress'] = 40
-        tasks[task_id]['message'] = '正在使用AI分离人声和伴奏...'
-        add_task_log(task_id, "Booting AI Engine...")
+    except Exception as e:
+        fail_task(task_id, e)
+
+def expand_playlist(playlist_url: str) -> list[str]:
+    """展开播放列表为单个视频链接（只读取列表，不下载）"""
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'skip_download': True,
+        'quiet': True,
+        'no_warnings': True,
+    }
+
+    import yt_dlp
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        logger.info(f"展开播放列表: {playlist_url}")
+        info = ydl.extract_info(playlist_url, download=False)
+
+    urls = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue
+        if entry.get('id'):
+            url = f"https://www.youtube.com/watch?v={entry['id']}"
+        elif entry.get('url'):
+            url = entry['url']
+        else:
+            continue
+        seed_video_metadata(url, entry)
+        urls.append(url)
+    return urls
+
+def job_task_ids(job: dict) -> list[str]:
+    """返回作业中仍在等待结果的任务（跳过已取消的任务）"""
+    return [tid for tid in job['task_ids'] if tasks.get(tid, {}).get('status') != 'error']
+
+def job_is_wanted(job: dict) -> bool:
+    """作业仍有用户在等待，或是预热作业"""
+    return job['warm'] or bool(job_task_ids(job))
+
+def job_log(job: dict, message: str):
+    """向作业关联的所有任务写日志"""
+    for task_id in job_task_ids(job):
+        add_task_log(task_id, message)
+
+def update_job_tasks(job: dict, status: str, progress: int, message: str):
+    """更新作业关联的所有任务状态"""
+    for task_id in job_task_ids(job):
+        tasks[task_id]['status'] = status
+        tasks[task_id]['progress'] = progress
+        tasks[task_id]['message'] = message
+
+def fail_job(job: dict, error: Exception):
+    """标记作业关联的所有任务失败"""
+    inflight_jobs.pop(job['cache_key'], None)
+    release_job_lease(job)
+    if job['warm']:
+        warm_attempts[job['cache_key']] = warm_attempts.get(job['cache_key'], 0) + 1
+        logger.warning(f"缓存预热失败 {job['url']}: {error}")
+    for task_id in job_task_ids(job):
+        fail_task(task_id, error)
+
+def spawn_background(coro):
+    """启动后台协程并保留引用，防止被垃圾回收"""
+    job = asyncio.create_task(coro)
+    background_jobs.add(job)
+    job.add_done_callback(background_jobs.discard)
+    return job
+
+async def keep_job_lease(job: dict):
+    """作业排队和分离期间定期续租；续租失败说明租约已被其他节点接管，中止本节点的计算"""
+    while True:
+        await asyncio.sleep(CACHE_LEASE_RENEW_SECONDS)
+        if not await asyncio.to_thread(cache_backend.acquire, job['cache_key'], CACHE_OWNER_ID):
+            logger.warning(f"租约已被其他节点接管，停止计算: {job['url']}")
+            job['lease_lost'] = True
+            job['cancel'].set()
+            return
+
+def hold_job_lease(job: dict):
+    """开始（或重新开始）为作业定期续租"""
+    stop_job_lease(job)
+    job['lease_keeper'] = spawn_background(keep_job_lease(job))
+
+def stop_job_lease(job: dict):
+    """停止续租（不释放租约）"""
+    keeper = job.pop('lease_keeper', None)
+    if keeper is not None:
+        keeper.cancel()
 
-        # 分离音轨
+def release_job_lease(job: dict):
+    """停止续租并释放租约"""
+    stop_job_lease(job)
+    cache_backend.release(job['cache_key'], CACHE_OWNER_ID)
+
+def job_queue_entry(job: dict) -> tuple:
+    """生成优先队列条目：先按优先级，再按老化后的预估开销（短任务优先），最后按提交顺序
+
+    老化后开销 = 开销 - JOB_AGING_RATE × 已等待时间。队列中的条目总在同一时刻比较，
+    这与按 开销 + JOB_AGING_RATE × 提交时刻 排序等价，因此入队后无需重新排序。
+    """
+    aged_cost = job['cost'] + JOB_AGING_RATE * job['submitted_at']
+    return (job['priority'], aged_cost, job['seq'], job)
+
+def ensure_pipeline():
+    """懒启动流水线工作协程（需在事件循环中调用）"""
+    global download_queue, separation_queue
+    if download_queue is None:
+        download_queue = asyncio.PriorityQueue()
+        separation_queue = asyncio.PriorityQueue(maxsize=SEPARATION_QUEUE_SIZE)
+        pipeline_workers.append(asyncio.create_task(download_worker()))
+        pipeline_workers.append(asyncio.create_task(separation_worker()))
+        logger.info("处理流水线已启动")
+
+def pipeline_idle() -> bool:
+    """流水线没有排队或处理中的作业"""
+    return not inflight_jobs
+
+def new_pipeline_job(youtube_url: Optional[str], metadata: dict, task_dir: Path, priority: int,
+                     cache_key: Optional[str] = None) -> dict:
+    """创建流水线作业并登记为处理中
+
+    上传的文件没有链接（youtube_url 为 None），需指定 cache_key 作为作业标识，结果不写入缓存。
+    """
+    ensure_pipeline()
+    cache_key = cache_key or get_cache_key(youtube_url)
+    job = {
+        'url': youtube_url,
+        'cache_key': cache_key,
+        'task_ids': [],
+        'task_dir': task_dir,
+        'audio_file': None,
+        'title': metadata.get('title') or Path(youtube_url).name[:50],
+        'priority': priority,
+        'cost': estimate_job_cost(metadata.get('duration')),
+        'seq': next(job_sequence),
+        'submitted_at': time.monotonic(),
+        'warm': priority == PRIORITY_WARM,
+        'cancel': threading.Event()
+    }
+    inflight_jobs[cache_key] = job
+    return job
+
+def requeue_as_user_job(job: dict):
+    """被中止的预热作业已有用户加入时，以用户优先级重新排队"""
+    job['warm'] = False
+    job['priority'] = PRIORITY_USER
+    job['cancel'] = threading.Event()
+    job['seq'] = next(job_sequence)
+    update_job_tasks(job, 'pending', 0, '排队等待下载...')
+    download_queue.put_nowait(job_queue_entry(job))
+
+def preempt_warm_jobs():
+    """用户作业到达时，中止正在进行的预热作业"""
+    for job in inflight_jobs.values():
+        if job['warm'] and not job['cancel'].is_set():
+            logger.info(f"预热作业让出资源: {job['url']}")
+            job['cancel'].set()
+
+def enqueue_youtube_job(task_id: str, youtube_url: str, metadata: dict):
+    """把任务加入流水线；同一视频已在处理中时共享其结果"""
+    job = inflight_jobs.get(get_cache_key(youtube_url))
+    if job is not None:
+        if job['task_ids']:
+            lead = tasks.get(job['task_ids'][0], {})
+            tasks[task_id]['status'] = lead.get('status', 'pending')
+            tasks[task_id]['progress'] = lead.get('progress', 0)
+            tasks[task_id]['message'] = lead.get('message', '等待同一歌曲的处理结果...')
+        # 用户加入的预热作业不再让出资源，之后按用户优先级进入分离队列
+        job['warm'] = False
+        job['priority'] = PRIORITY_USER
+        job['task_ids'].append(task_id)
+        add_task_log(task_id, "Same track already in pipeline, sharing its result...")
+        return
+
+    preempt_warm_jobs()
+    job = new_pipeline_job(youtube_url, metadata, WORK_DIR / task_id, PRIORITY_USER)
+    job['task_ids'].append(task_id)
+    download_queue.put_nowait(job_queue_entry(job))
+    tasks[task_id]['message'] = '排队等待下载...'
+    add_task_log(task_id, f"Queued for download (estimated cost {int(job['cost'])}s).")
+
+def enqueue_warm_job(youtube_url: str, metadata: dict):
+    """以最低优先级把预热作业加入流水线"""
+    job = new_pipeline_job(
+        youtube_url, metadata, WORK_DIR / f"warm-{get_cache_key(youtube_url)}", PRIORITY_WARM
+    )
+    download_queue.put_nowait(job_queue_entry(job))
+    logger.info(f"缓存预热: {youtube_url}")
+
+async def download_worker():
+    """下载阶段：逐个下载音频，交给分离阶段后立即开始下一首"""
+    while True:
+        *_, job = await download_queue.get()
         try:
-            # 优先使用Demucs
-            add_task_log(task_id, "Running Demucs separation...")
-            separated = separate_audio_demucs(audio_file, str(task_dir))
+            if not job_is_wanted(job) or job['cancel'].is_set():
+                raise JobCancelled("作业已取消")
+
+            # 其他节点或进程正在计算同一首歌时，等待其结果而不是重复处理
+            if not await asyncio.to_thread(cache_backend.acquire, job['cache_key'], CACHE_OWNER_ID):
+                stop_job_lease(job)
+                update_job_tasks(job, 'pending', 5, '其他节点正在处理同一歌曲，等待结果...')
+                job_log(job, "Another worker is processing this track, waiting for its result...")
+                spawn_background(wait_for_peer(job))
+                continue
+            hold_job_lease(job)
+
+            update_job_tasks(job, 'downloading', 10, '正在从YouTube下载音频...')
+            job_log(job, "Downloading audio track...")
+            job['task_dir'].mkdir(exist_ok=True)
+            job['audio_file'] = await asyncio.to_thread(
+                download_youtube_audio, job['url'], str(job['task_dir'] / "original"), job['cancel']
+            )
+            job_log(job, "Download completed!")
+            update_job_tasks(job, 'downloading', 35, '下载完成，排队等待分离...')
+
+            # 分离阶段繁忙时在此等待，限制预先下载的数量
+            await separation_queue.put(job_queue_entry(job))
+        except JobCancelled:
+            handle_cancelled_job(job)
         except Exception as e:
-            logger.warning(f"Demucs失败，尝试Spleeter: {str(e)}")
-            add_task_log(task_id, "Demucs failed, trying Spleeter...")
-            # 备用Spleeter
-            try:
-                separated = separate_audio_spleeter(audio_file, str(task_dir))
-            except Exception as e2:
-                logger.warning(f"Spleeter 也失败，尝试简单 ffmpeg 方案: {str(e2)}")
-                add_task_log(task_id, "Spleeter failed, using simple ffmpeg method...")
-                separated = separate_audio_simple_ffmpeg(audio_file, str(task_dir))
-
-        add_task_log(task_id, "Separation completed!")
-
-        # 保存到缓存
-        title = Path(youtube_url).name[:50]
-        if separated['vocals'] and separated['instrumental']:
-            add_task_log(task_id, "Saving to cache for future use...")
-            save_to_cache(youtube_url, separated['vocals'], separated['instrumental'], title)
-
-        add_task_log(task_id, "TASK_COMPLETED")
-
-        # 更新状态：完成
-        tasks[task_id]['status'] = 'completed'
-        tasks[task_id]['progress'] = 100
-        tasks[task_id]['message'] = '处理完成！'
-        tasks[task_id]['title'] = title
-        tasks[task_id]['vocal_url'] = f"/download/{task_id}/vocals"
-        tasks[task_id]['instrumental_url'] = f"/download/{task_id}/instrumental"
-        tasks[task_id]['vocal_file'] = separated['vocals']
-        tasks[task_id]['instrumental_file'] = separated['instrumental']
-
-        # 添加到历史记录
-        history[task_id] = {
-            'title': tasks[task_id]['title'],
-            'date': 'recent'
-        }
+            fail_job(job, e)
+        finally:
+            download_queue.task_done()
+
+def handle_cancelled_job(job: dict):
+    """作业被中止：租约被接管则等待接管节点的结果；已有用户加入则重新排队，否则丢弃"""
+    if job.pop('lease_lost', False) and job_is_wanted(job):
+        stop_job_lease(job)
+        job['cancel'] = threading.Event()
+        update_job_tasks(job, 'pending', 5, '其他节点正在处理同一歌曲，等待结果...')
+        job_log(job, "Another worker took over this track, waiting for its result...")
+        spawn_background(wait_for_peer(job))
+        return
+    if job_task_ids(job):
+        requeue_as_user_job(job)
+        return
+    inflight_jobs.pop(job['cache_key'], None)
+    release_job_lease(job)
+    if job['warm']:
+        shutil.rmtree(job['task_dir'], ignore_errors=True)
+
+async def wait_for_peer(job: dict):
+    """轮询缓存，直到持有租约的节点发布结果，或其租约过期后由本节点接管"""
+    while job_is_wanted(job) and not job['cancel'].is_set():
+        await asyncio.sleep(CACHE_POLL_SECONDS)
+
+        cached_result = await asyncio.to_thread(check_cache, job['url'])
+        if cached_result:
+            for task_id in job_task_ids(job):
+                complete_task_from_cache(task_id, cached_result)
+            inflight_jobs.pop(job['cache_key'], None)
+            return
+
+        if await asyncio.to_thread(cache_backend.acquire, job['cache_key'], CACHE_OWNER_ID):
+            job['seq'] = next(job_sequence)
+            download_queue.put_nowait(job_queue_entry(job))
+            return
+
+    handle_cancelled_job(job)
+
+def job_stem_dir(job: dict) -> str:
+    """Spleeter 直接写入音轨的暂存目录，发布到缓存时只需 rename（上传作业写入任务目录）"""
+    if job['url'] is None:
+        return str(job['task_dir'])
+    return str(cache_backend.staging_dir(job['cache_key']))
+
+async def finish_separated_job(job: dict, separated: dict):
+    """保存分离结果到缓存并完成作业关联的任务"""
+    job_log(job, "Separation completed!")
+
+    title = job['title']
+    if job['url'] is not None and separated['vocals'] and separated['instrumental']:
+        job_log(job, "Saving to cache for future use...")
+        cached_result = await asyncio.to_thread(
+            save_to_cache, job['url'], separated['vocals'], separated['instrumental'], title
+        )
+        if cached_result is None:
+            # 发布中途失败时暂存文件可能已被移走，重新查询缓存而不是沿用旧路径
+            cached_result = await asyncio.to_thread(check_cache, job['url'])
+        if cached_result:
+            # 任务直接引用缓存文件，衍生版本随缓存项一起复用和清理
+            separated = {
+                'vocals': cached_result['vocals'],
+                'instrumental': cached_result['instrumental']
+            }
 
-        logger.info(f"任务完成: {task_id}")
+    for task_id in job_task_ids(job):
+        complete_task(task_id, title, separated)
+    if job['url'] is not None:
+        update_popularity_title(job['url'], title)
 
+    if job['warm']:
+        shutil.rmtree(job['task_dir'], ignore_errors=True)
+        logger.info(f"缓存预热完成: {job['url']}")
+    else:
+        logger.info(f"流水线作业完成: {job['url'] or title}")
+    inflight_jobs.pop(job['cache_key'], None)
+    release_job_lease(job)
+
+def start_separation(job: dict) -> bool:
+    """标记作业进入分离阶段；作业已不需要时返回 False"""
+    if not job_is_wanted(job) or job['cancel'].is_set():
+        handle_cancelled_job(job)
+        return False
+    # 续租协程两次检查之间租约可能已被接管，开始分离前再确认一次（上传作业没有租约）
+    if job['url'] is not None and not cache_backend.acquire(job['cache_key'], CACHE_OWNER_ID):
+        logger.warning(f"租约已被其他节点接管，不再分离: {job['url']}")
+        job['lease_lost'] = True
+        handle_cancelled_job(job)
+        return False
+    update_job_tasks(job, 'separating', 40, '正在使用AI分离人声和伴奏...')
+    job_log(job, "Booting AI Engine...")
+    return True
+
+async def run_separation_job(job: dict):
+    """按 Demucs -> Spleeter -> ffmpeg 的顺序分离单个作业"""
+    try:
+        if not start_separation(job):
+            return
+        separated = await asyncio.to_thread(
+            separate_with_fallback,
+            job['audio_file'], str(job['task_dir']), lambda msg: job_log(job, msg),
+            job['cancel'], job_stem_dir(job)
+        )
+        await finish_separated_job(job, separated)
+    except JobCancelled:
+        handle_cancelled_job(job)
     except Exception as e:
-        logger.error(f"任务失败 {task_id}: {str(e)}")
-        tasks[task_id]['status'] = 'error'
-        tasks[task_id]['message'] = f'处理失败: {str(e)}'
-        add_task_log(task_id, f"ERROR: {str(e)}")
+        fail_job(job, e)
 
+async def run_spleeter_batch(batch: list[dict]):
+    """用常驻 Spleeter 一次处理多个排队作业"""
+    jobs = [job for job in batch if start_separation(job)]
+    if not jobs:
+        return
 
-async def process_upload_task(task_id: str, input_file: str, filename: str):
-    """后台任务：处理上传的音频文件"""
+    for job in jobs:
+        job_log(job, f"Running resident Spleeter (batch of {len(jobs)})...")
     try:
-        tasks[task_id]['status'] = 'separating'
-        tasks[task_id]['progress'] = 40
-        tasks[task_id]['message'] = '正在使用AI分离人声和伴奏...'
-        add_task_log(task_id, "Booting AI Engine...")
+        results = await asyncio.to_thread(
+            separate_batch_spleeter,
+            [job['audio_file'] for job in jobs], [job_stem_dir(job) for job in jobs]
+        )
+    except Exception as e:
+        # 批量失败时逐个走完整的降级流程
+        logger.warning(f"Spleeter 批量分离失败，逐个处理: {e}")
+        for job in jobs:
+            await run_separation_job(job)
+        return
 
-        # 分离音轨
+    for job, separated in zip(jobs, results):
         try:
-            add_task_log(task_id, "Running Demucs separation...")
-            separated = separate_audio_demucs(input_file, str(Path(input_file).parent))
+            await finish_separated_job(job, separated)
         except Exception as e:
-            logger.warning(f"Demucs失败，尝试Spleeter: {str(e)}")
-            add_task_log(task_id, "Demucs failed, trying Spleeter...")
-            try:
-                separated = separate_audio_spleeter(input_file, str(Path(input_file).parent))
-            except Exception as e2:
-                logger.warning(f"Spleeter 也失败，尝试简单 ffmpeg 方案: {str(e2)}")
-                add_task_log(task_id, "Spleeter failed, using simple ffmpeg method...")
-                separated = separate_audio_simple_ffmpeg(input_file, str(Path(input_file).parent))
-
-        add_task_log(task_id, "Separation completed!")
-        add_task_log(task_id, "TASK_COMPLETED")
-
-        # 更新状态：完成
-        tasks[task_id]['status'] = 'completed'
-        tasks[task_id]['progress'] = 100
-        tasks[task_id]['message'] = '处理完成！'
-        tasks[task_id]['title'] = Path(filename).stem[:50]
-        tasks[task_id]['vocal_url'] = f"/download/{task_id}/vocals"
-        tasks[task_id]['instrumental_url'] = f"/download/{task_id}/instrumental"
-        tasks[task_id]['vocal_file'] = separated['vocals']
-        tasks[task_id]['instrumental_file'] = separated['instrumental']
-
-        # 添加到历史记录
-        history[task_id] = {
-            'title': tasks[task_id]['title'],
-            'date': 'recent'
-        }
+            fail_job(job, e)
+
+async def separation_worker():
+    """分离阶段：与后续歌曲的下载并行执行"""
+    while True:
+        *_, job = await separation_queue.get()
+        batch = [job]
+
+        # Demucs 不可用时，一次取出多个排队作业交给常驻 Spleeter 批量处理
+        if demucs_recently_failed():
+            total_cost = job['cost']
+            while len(batch) < SPLEETER_BATCH_SIZE and not separation_queue.empty():
+                entry = separation_queue.get_nowait()
+                extra = entry[-1]
+                if total_cost + extra['cost'] > SPLEETER_BATCH_MAX_SECONDS:
+                    # 超出单批时长上限，放回队列留给下一批（刚取出一项，队列必有空位）
+                    separation_queue.put_nowait(entry)
+                    separation_queue.task_done()
+                    break
+                batch.append(extra)
+                total_cost += extra['cost']
 
-        logger.info(f"上传任务完成: {task_id}")
+        try:
+            if len(batch) > 1:
+                await run_spleeter_batch(batch)
+            else:
+                await run_separation_job(job)
+        finally:
+            for _ in batch:
+                separation_queue.task_done()
+
+def read_warm_seed_list() -> list[str]:
+    """读取预热种子列表（每行一个链接，# 开头为注释）"""
+    if not WARM_SEED_FILE or not Path(WARM_SEED_FILE).exists():
+        return []
+    with open(WARM_SEED_FILE, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#') and is_youtube_url(line)]
+
+def warm_candidates() -> list[str]:
+    """预热候选：先种子列表，再按热度排序的前 N 首"""
+    ranked = sorted(song_popularity.values(), key=popularity_score, reverse=True)
+    candidates = read_warm_seed_list() + [stats['url'] for stats in ranked[:WARM_TOP_N]]
+
+    result = []
+    for url in candidates:
+        cache_key = get_cache_key(url)
+        if cache_key in inflight_jobs or warm_attempts.get(cache_key, 0) >= WARM_MAX_ATTEMPTS:
+            continue
+        if url not in result and not cache_backend.contains(cache_key):
+            result.append(url)
+    return result
+
+async def cache_warm_loop():
+    """后台循环：流水线空闲时预先分离热门歌曲，补回被删除的缓存"""
+    while True:
+        await asyncio.sleep(WARM_INTERVAL_SECONDS)
+        try:
+            if popularity_dirty:
+                await asyncio.to_thread(save_popularity)
 
-    except Exception as e:
-        logger.error(f"上传任务失败 {task_id}: {str(e)}")
-        tasks[task_id]['status'] = 'error'
-        tasks[task_id]['message'] = f'处理失败: {str(e)}'
-        add_task_log(task_id, f"ERROR: {str(e)}")
+            if not pipeline_idle():
+                continue
+
+            for url in warm_candidates():
+                try:
+                    metadata = await asyncio.to_thread(fetch_video_metadata, url)
+                except Exception as e:
+                    logger.warning(f"预热获取元数据失败 {url}: {e}")
+                    warm_attempts[get_cache_key(url)] = warm_attempts.get(get_cache_key(url), 0) + 1
+                    continue
+
+                duration = metadata.get('duration')
+                if duration is not None and duration > MAX_DURATION_SECONDS:
+                    warm_attempts[get_cache_key(url)] = WARM_MAX_ATTEMPTS
+                    continue
+
+                # 查询元数据期间可能有用户作业到达
+                if pipeline_idle():
+                    enqueue_warm_job(url, metadata)
+                break
+        except Exception as e:
+            logger.error(f"缓存预热循环出错: {e}")
+
+@app.on_event("startup")
+async def start_cache_warmer():
+    """启动缓存预热后台循环"""
+    if WARM_ENABLED:
+        spawn_background(cache_warm_loop())
+        logger.info("缓存预热已启用")
+
+async def prepare_runtime():
+    """后台探测运行环境能力，按配置预加载模型，完成后标记就绪"""
+    startup_state['phase'] = 'probing'
+    await asyncio.to_thread(probe_capabilities)
+
+    if PRELOAD_MODELS:
+        startup_state['phase'] = 'preloading'
+        startup_state['preload'] = await asyncio.to_thread(preload_models)
+        await asyncio.to_thread(probe_capabilities, True)
+
+    startup_state['ready'] = True
+    startup_state['phase'] = 'ready'
+    startup_state['ready_seconds'] = round(time.perf_counter() - PROCESS_START, 3)
+    logger.info(f"服务就绪，距进程启动 {startup_state['ready_seconds']} 秒")
+
+@app.on_event("startup")
+async def start_runtime_probe():
+    """记录启动耗时，在后台探测能力（不阻塞端口监听）"""
+    startup_state['startup_seconds'] = round(time.perf_counter() - PROCESS_START, 3)
+    spawn_background(prepare_runtime())
+
+@app.middleware("http")
+async def record_request_timing(request: Request, call_next):
+    """记录首个请求距进程启动的时间，以及 /health 的响应耗时"""
+    started = time.perf_counter()
+    if startup_state['first_request_seconds'] is None:
+        startup_state['first_request_seconds'] = round(started - PROCESS_START, 3)
+        logger.info(f"首个请求距进程启动 {startup_state['first_request_seconds']} 秒")
+
+    response = await call_next(request)
+
+    if request.url.path == "/health":
+        health_latencies.append((time.perf_counter() - started) * 1000)
+    return response
+
+@app.on_event("shutdown")
+async def release_inflight_leases():
+    """退出前释放本进程持有的租约，重启后同一首歌可以立即重新计算"""
+    for job in list(inflight_jobs.values()):
+        release_job_lease(job)
+
+@app.on_event("shutdown")
+async def flush_popularity():
+    """退出前保存热度统计"""
+    if popularity_dirty:
+        save_popularity()
+
+def get_batch_summary(batch_id: str) -> dict:
+    """汇总批量任务进度"""
+    batch = batches[batch_id]
+    items = [tasks[tid] for tid in batch['task_ids'] if tid in tasks]
+    total = len(items)
+    completed = sum(1 for t in items if t['status'] == 'completed')
+    failed = sum(1 for t in items if t['status'] == 'error')
+
+    # 失败的条目视为已结束，不拖慢整体进度
+    progress = sum(100 if t['status'] == 'error' else t['progress'] for t in items) // max(total, 1)
+
+    if completed + failed < total:
+        status = 'processing'
+    else:
+        status = 'completed' if completed else 'error'
+
+    return {
+        'batch_id': batch_id,
+        'status': status,
+        'progress': progress,
+        'message': f'已完成 {completed}/{total}，失败 {failed}',
+        'total': total,
+        'completed': completed,
+        'failed': failed,
+        'cached': batch['cached'],
+        'duplicates': batch['duplicates'],
+        'items': items
+    }
 
 @app.post("/api/process", response_model=TaskStatus)
 async def process_youtube(request: YouTubeRequest, background_tasks: BackgroundTasks):
     """提交YouTube链接进行处理"""
 
     # 验证URL
-    if not request.url or 'youtube.com' not in request.url and 'youtu.be' not in request.url:
+    if not is_youtube_url(request.url):
         raise HTTPException(status_code=400, detail="无效的YouTube链接")
 
     # 创建任务
-    task_id = str(uuid.uuid4())
-    tasks[task_id] = {
-        'task_id': task_id,
-        'status': 'pending',
-        'progress': 0,
-        'message': '任务已创建，等待处理...',
-        'title': None,
-        'vocal_url': None,
-        'instrumental_url': None,
-        'lyrics': None
-    }
-
-    # 初始化日志
-    task_logs[task_id] = []
+    task_id = create_task(request.url)
 
     # 添加到后台任务
     background_tasks.add_task(process_youtube_task, task_id, request.url)
@@ -460,6 +2006,75 @@ async def process_youtube_alias(request: YouTubeRequest, background_tasks: Backg
     return await process_youtube(request, background_tasks)
 
 
+@app.post("/api/batch", response_model=BatchStatus)
+async def process_batch(request: BatchRequest):
+    """批量提交YouTube链接或播放列表，下载与分离以流水线方式重叠执行"""
+    urls = [u.strip() for u in request.urls if u and u.strip()]
+
+    # 展开播放列表
+    if request.playlist_url:
+        if not is_youtube_url(request.playlist_url) or not is_playlist_url(request.playlist_url):
+            raise HTTPException(status_code=400, detail="无效的YouTube播放列表链接")
+        try:
+            urls.extend(await asyncio.to_thread(expand_playlist, request.playlist_url))
+        except Exception as e:
+            logger.error(f"展开播放列表失败: {e}")
+            raise HTTPException(status_code=400, detail=f"无法读取播放列表: {str(e)}")
+
+    if not urls:
+        raise HTTPException(status_code=400, detail="没有可处理的链接")
+
+    for url in urls:
+        if not is_youtube_url(url):
+            raise HTTPException(status_code=400, detail=f"无效的YouTube链接: {url}")
+
+    # 批内去重
+    seen = set()
+    unique_urls = []
+    for url in urls:
+        cache_key = get_cache_key(url)
+        if cache_key not in seen:
+            seen.add(cache_key)
+            unique_urls.append(url)
+
+    if len(unique_urls) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {MAX_BATCH_SIZE} 首")
+
+    batch_id = str(uuid.uuid4())
+    task_ids = []
+    cached = 0
+
+    for url in unique_urls:
+        task_id = create_task(url)
+        task_ids.append(task_id)
+        add_task_log(task_id, f"Batch {batch_id}: {url}")
+
+        # 缓存命中的条目直接完成，不进入流水线
+        cached_result = await asyncio.to_thread(check_cache, url)
+        if cached_result:
+            record_popularity(url, 'submissions')
+            record_popularity(url, 'cache_hits', cached_result.get('title'))
+            complete_task_from_cache(task_id, cached_result)
+            cached += 1
+        else:
+            spawn_background(process_youtube_task(task_id, url))
+
+    batches[batch_id] = {
+        'task_ids': task_ids,
+        'cached': cached,
+        'duplicates': len(urls) - len(unique_urls)
+    }
+    logger.info(f"批量任务已创建: {batch_id} ({len(task_ids)} 首, 缓存命中 {cached})")
+
+    return get_batch_summary(batch_id)
+
+@app.get("/api/batch/{batch_id}", response_model=BatchStatus)
+async def get_batch_status(batch_id: str):
+    """查询批量任务的汇总进度"""
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return get_batch_summary(batch_id)
+
 @app.post("/api/upload", response_model=TaskStatus)
 async def upload_audio(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """上传音频文件并开始分离处理（multipart/form-data）"""
@@ -476,20 +2091,7 @@ async def upload_audio(background_tasks: BackgroundTasks, file: UploadFile = Fil
         raise HTTPException(status_code=400, detail=f'不支持的文件类型: {ext}')
 
     # 创建任务
-    task_id = str(uuid.uuid4())
-    tasks[task_id] = {
-        'task_id': task_id,
-        'status': 'pending',
-        'progress': 0,
-        'message': '任务已创建，等待处理...',
-        'title': None,
-        'vocal_url': None,
-        'instrumental_url': None,
-        'lyrics': None
-    }
-
-    # 初始化日志
-    task_logs[task_id] = []
+    task_id = create_task()
 
     task_dir = WORK_DIR / task_id
     task_dir.mkdir(exist_ok=True)
@@ -563,9 +2165,8 @@ async def stop_task(task_id: str):
         add_task_log(task_id, "Task cancelled by user")
     return {"status": "stopped"}
 
-@app.get("/download/{task_id}/{track_type}")
-async def download_track(task_id: str, track_type: str):
-    """下载分离后的音轨"""
+def resolve_track_file(task_id: str, track_type: str) -> tuple[str, str, str]:
+    """返回已完成任务的音轨文件路径、下载文件名和媒体类型"""
     if task_id not in tasks:
         raise HTTPException(status_code=404, detail="任务不存在")
 
@@ -593,22 +2194,221 @@ async def download_track(task_id: str, track_type: str):
     if not file_path or not Path(file_path).exists():
         raise HTTPException(status_code=404, detail="文件不存在")
 
+    return file_path, filename, media_type
+
+def parse_range_header(range_header: Optional[str], total_size: int) -> Optional[tuple[int, int]]:
+    """解析单段 Range 请求头，返回字节闭区间；没有 Range 时返回 None"""
+    if not range_header:
+        return None
+
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or match.groups() == ('', ''):
+        raise HTTPException(status_code=416, detail="无效的 Range 请求",
+                            headers={'Content-Range': f'bytes */{total_size}'})
+
+    first, last = match.groups()
+    if first == '':
+        start = max(total_size - int(last), 0)
+        end = total_size - 1
+    else:
+        start = int(first)
+        end = min(int(last), total_size - 1) if last else total_size - 1
+
+    if start > end or start >= total_size:
+        raise HTTPException(status_code=416, detail="Range 超出文件范围",
+                            headers={'Content-Range': f'bytes */{total_size}'})
+    return start, end
+
+def ranged_response(total_size: int, iter_range, range_header: Optional[str],
+                    media_type: str, filename: str, etag: Optional[str] = None,
+                    if_range: Optional[str] = None) -> StreamingResponse:
+    """按 Range 请求返回完整内容 (200) 或部分内容 (206)，iter_range(start, end) 生成字节
+
+    If-Range 与 etag 不一致时（内容已变化）忽略 Range，返回完整内容。
+    """
+    if if_range is not None and if_range != etag:
+        range_header = None
+    byte_range = parse_range_header(range_header, total_size)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    }
+    if etag:
+        headers['ETag'] = etag
+    if byte_range is None:
+        start, end, status_code = 0, total_size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{total_size}'
+    headers['Content-Length'] = str(end - start + 1)
+
+    return StreamingResponse(
+        iter_range(start, end), status_code=status_code, media_type=media_type, headers=headers
+    )
+
+def iter_file_range(path: str, start: int, end: int):
+    """按块读取文件的字节闭区间 [start, end]"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(MIX_FILE_CHUNK_BYTES, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+async def encode_mix_preset(vocal_file: str, instrumental_file: str, vocal_gain: float,
+                            instrumental_gain: float, preset_file: Path):
+    """后台把常用增益组合编码为 MP3，之后直接作为静态文件返回"""
+    try:
+        preset_file.parent.mkdir(exist_ok=True)
+        await asyncio.to_thread(
+            encode_guide_mix, vocal_file, instrumental_file, vocal_gain, instrumental_gain, str(preset_file)
+        )
+        logger.info(f"导唱混音预设已编码: {preset_file}")
+    except Exception as e:
+        logger.error(f"导唱混音编码失败: {e}")
+    finally:
+        mix_encoding.pop(str(preset_file), None)
+
+def schedule_mix_encode(vocal_file: str, instrumental_file: str, vocal_gain: float,
+                        instrumental_gain: float, preset_file: Path) -> asyncio.Task:
+    """启动 MP3 编码，同一预设正在编码时复用进行中的任务"""
+    job = mix_encoding.get(str(preset_file))
+    if job is None:
+        job = spawn_background(
+            encode_mix_preset(vocal_file, instrumental_file, vocal_gain, instrumental_gain, preset_file)
+        )
+        mix_encoding[str(preset_file)] = job
+    return job
+
+def mix_etag(label: str, *paths: Path) -> str:
+    """按增益组合和源文件的大小、修改时间生成 ETag"""
+    parts = [label] + [f"{p.stat().st_size}:{p.stat().st_mtime_ns}" for p in map(Path, paths)]
+    return '"' + hashlib.md5('|'.join(parts).encode()).hexdigest()[:16] + '"'
+
+@app.get("/download/{task_id}/mix")
+async def download_guide_mix(task_id: str, request: Request, vocal_gain: float = 0.2,
+                             instrumental_gain: float = 1.0,
+                             audio_format: str = Query('wav', alias='format')):
+    """下载导唱混音（伴奏 + 部分人声），支持 Range
+
+    format=wav（默认）从内存映射的音轨逐块计算并流式返回；format=mp3 返回编码好的预设，
+    尚未编码时先编码。同一 URL 始终返回同一格式，播放器续传不会拼接两种格式。
+    """
+    vocal_file, _, _ = resolve_track_file(task_id, 'vocals')
+    instrumental_file, _, _ = resolve_track_file(task_id, 'instrumental')
+
+    if audio_format not in ('wav', 'mp3'):
+        raise HTTPException(status_code=400, detail="format 只支持 wav 或 mp3")
+    if not (0 <= vocal_gain <= MAX_MIX_GAIN and 0 <= instrumental_gain <= MAX_MIX_GAIN):
+        raise HTTPException(status_code=400, detail=f"增益范围为 0-{MAX_MIX_GAIN}")
+
+    # 增益按 0.05 取整，便于复用预设
+    vocal_gain = round(vocal_gain * 20) / 20
+    instrumental_gain = round(instrumental_gain * 20) / 20
+    label = f"mix_v{int(round(vocal_gain * 100))}_i{int(round(instrumental_gain * 100))}"
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    preset_file = Path(instrumental_file).parent / "mixes" / f"{label}.mp3"
+
+    # MP3：已编码的预设直接作为静态文件返回
+    if audio_format == 'mp3':
+        if not preset_file.exists():
+            # 客户端断开也不中止编码，结果留给后续请求
+            await asyncio.shield(
+                schedule_mix_encode(vocal_file, instrumental_file, vocal_gain, instrumental_gain, preset_file)
+            )
+            if not preset_file.exists():
+                raise HTTPException(status_code=500, detail="MP3 编码失败")
+        return ranged_response(
+            preset_file.stat().st_size,
+            lambda start, end: iter_file_range(str(preset_file), start, end),
+            range_header, 'audio/mpeg', f"{label}.mp3",
+            mix_etag(label, preset_file), if_range
+        )
+
+    try:
+        mix = await asyncio.to_thread(open_guide_mix, vocal_file, instrumental_file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"无法混音: {str(e)}")
+
+    response = ranged_response(
+        mix['total_size'],
+        lambda start, end: iter_guide_mix(mix, vocal_gain, instrumental_gain, start, end),
+        range_header, 'audio/wav', f"{label}.wav",
+        mix_etag(label, vocal_file, instrumental_file), if_range
+    )
+
+    # 只统计从头开始的请求（播放器的后续 Range 请求不重复计数）
+    gains = (vocal_gain, instrumental_gain)
+    if range_header is None or range_header.strip().startswith('bytes=0-'):
+        mix_request_counts[gains] = mix_request_counts.get(gains, 0) + 1
+    popular = gains in MIX_PRESETS or mix_request_counts.get(gains, 0) >= MIX_PRESET_MIN_REQUESTS
+    if popular and not preset_file.exists():
+        # 预先编码，之后 format=mp3 的请求直接返回静态文件
+        schedule_mix_encode(vocal_file, instrumental_file, vocal_gain, instrumental_gain, preset_file)
+
+    return response
+
+@app.get("/download/{task_id}/{track_type}")
+async def download_track(task_id: str, track_type: str):
+    """下载分离后的音轨"""
+    file_path, filename, media_type = resolve_track_file(task_id, track_type)
+
+    # 每个任务只计一次下载（人声、伴奏和播放器的 Range 续传都不重复计数）
+    source_url = tasks[task_id].get('source_url')
+    if source_url and not tasks[task_id].get('downloaded'):
+        tasks[task_id]['downloaded'] = True
+        record_popularity(source_url, 'downloads', tasks[task_id].get('title'))
+
     return FileResponse(
         file_path,
         media_type=media_type,
         filename=filename
     )
 
+@app.get("/download/{task_id}/{track_type}/render")
+async def download_rendition(task_id: str, track_type: str, semitones: int = 0, tempo: float = 1.0):
+    """下载变调/变速版本（服务端渲染，每个版本只渲染一次）"""
+    file_path, filename, media_type = resolve_track_file(task_id, track_type)
+
+    if not -MAX_SEMITONES <= semitones <= MAX_SEMITONES:
+        raise HTTPException(status_code=400, detail=f"变调范围为 ±{MAX_SEMITONES} 个半音")
+    if not MIN_TEMPO <= tempo <= MAX_TEMPO:
+        raise HTTPException(status_code=400, detail=f"速度范围为 {MIN_TEMPO}-{MAX_TEMPO} 倍")
+
+    tempo = round(tempo, 2)
+    if semitones == 0 and tempo == 1.0:
+        return FileResponse(file_path, media_type=media_type, filename=filename)
+
+    rendition_file = get_rendition_path(file_path, semitones, tempo)
+    if not rendition_file.exists():
+        lock = rendition_locks.setdefault(str(rendition_file), asyncio.Lock())
+        async with lock:
+            if not rendition_file.exists():
+                rendition_file.parent.mkdir(exist_ok=True)
+                try:
+                    await asyncio.to_thread(render_rendition, file_path, str(rendition_file), semitones, tempo)
+                except Exception as e:
+                    logger.error(f"渲染变调/变速版本失败: {e}")
+                    raise HTTPException(status_code=500, detail=f"渲染失败: {str(e)}")
+
+    return FileResponse(
+        str(rendition_file),
+        media_type='audio/wav',
+        filename=f"{Path(filename).stem}_{semitones:+d}st_{tempo:.2f}x.wav"
+    )
+
 @app.get("/api/cache/stats")
 async def get_cache_stats():
     """获取缓存统计信息"""
-    if not CACHE_DIR.exists():
-        return {"cached_items": 0, "total_size_mb": 0, "items": []}
-
     items = []
     total_size = 0
 
-    for cache_path in CACHE_DIR.iterdir():
+    for cache_path in cache_backend.entries():
         if cache_path.is_dir():
             metadata_file = cache_path / "metadata.json"
             if metadata_file.exists():
@@ -636,16 +2436,31 @@ async def get_cache_stats():
         "items": items
     }
 
+@app.get("/api/cache/popularity")
+async def get_cache_popularity(limit: int = 20):
+    """获取最热门的歌曲及其缓存状态"""
+    ranked = sorted(song_popularity.items(), key=lambda item: popularity_score(item[1]), reverse=True)
+    return {
+        "warm_enabled": WARM_ENABLED,
+        "items": [
+            {
+                'song_id': song_id,
+                **stats,
+                'score': popularity_score(stats),
+                'cached': cache_backend.contains(get_cache_key(stats['url']))
+            }
+            for song_id, stats in ranked[:limit]
+        ]
+    }
+
 @app.delete("/api/cache/{cache_key}")
 async def delete_cache_item(cache_key: str):
     """删除特定缓存项"""
-    cache_path = CACHE_DIR / cache_key
-
-    if not cache_path.exists():
+    if cache_key.startswith('.') or not cache_backend.entry_dir(cache_key).exists():
         raise HTTPException(status_code=404, detail="缓存项不存在")
 
     try:
-        shutil.rmtree(cache_path)
+        cache_backend.delete(cache_key)
         logger.info(f"已删除缓存: {cache_key}")
         return {"status": "ok", "message": "缓存已删除"}
     except Exception as e:
@@ -656,57 +2471,75 @@ async def delete_cache_item(cache_key: str):
 async def clear_all_cache():
     """清空所有缓存"""
     try:
-        if CACHE_DIR.exists():
-            shutil.rmtree(CACHE_DIR)
-            CACHE_DIR.mkdir(exist_ok=True)
+        cache_backend.clear()
         logger.info("已清空所有缓存")
         return {"status": "ok", "message": "所有缓存已清空"}
     except Exception as e:
         logger.error(f"清空缓存失败: {e}")
         raise HTTPException(status_code=500, detail=f"清空失败: {str(e)}")
 
-@app.get("/health")
-async def health_check():
-    """健康检查 (增强版)"""
-    import shutil
-    import platform
-
-    # 跨平台检查命令是否存在
-    system = platform.system()
-
-    # 检查 demucs
-    demucs_ok = shutil.which('demucs') is not None
-
-    # 检查 ffmpeg
-    ffmpeg_ok = shutil.which('ffmpeg') is not None
+def health_latency_summary() -> dict:
+    """汇总最近的 /health 响应耗时（毫秒）"""
+    if not health_latencies:
+        return {'samples': 0}
+    values = sorted(health_latencies)
+    return {
+        'samples': len(values),
+        'last_ms': round(health_latencies[-1], 2),
+        'avg_ms': round(sum(values) / len(values), 2),
+        'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+    }
 
-    # 如果系统没有 ffmpeg，尝试检测 imageio-ffmpeg 提供的内置二进制
-    if not ffmpeg_ok:
-        try:
-            from imageio_ffmpeg import get_ffmpeg_exe
-            ff_exe = get_ffmpeg_exe()
-            ffmpeg_ok = Path(ff_exe).exists()
-        except Exception:
-            pass
+@app.get("/health")
+async def health_check(refresh: bool = False):
+    """健康检查 (增强版)：读取启动时缓存的能力探测结果，refresh=true 时重新探测"""
+    if refresh:
+        await asyncio.to_thread(probe_capabilities, True)
 
-    # 检测 GPU 支持
-    has_gpu, device = detect_gpu_support()
+    # 启动探测尚未完成时不等待，直接报告未就绪
+    caps = capabilities
+    engines = caps.get('engines') or {}
+    has_gpu = caps.get('gpu_available')
 
     # 统计缓存
-    cache_count = len(list(CACHE_DIR.iterdir())) if CACHE_DIR.exists() else 0
+    cache_count = len(cache_backend.entries())
 
     return {
         "status": "ok",
-        "platform": system,
-        "demucs_available": demucs_ok,
-        "ffmpeg_available": ffmpeg_ok,
+        "ready": startup_state['ready'],
+        "platform": caps.get('platform') or platform.system(),
+        "demucs_available": engines.get('demucs'),
+        "ffmpeg_available": engines.get('ffmpeg'),
         "gpu_available": has_gpu,
-        "device": device,
+        "device": caps.get('device'),
         "cache_enabled": True,
         "cached_items": cache_count,
-        "optimization_level": "high" if has_gpu else "standard"
+        "optimization_level": "high" if has_gpu else "standard",
+        "startup": startup_state,
+        "health_latency": health_latency_summary()
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：能力探测（及可选的模型预加载）完成前返回 503"""
+    if not startup_state['ready']:
+        raise HTTPException(status_code=503, detail=f"服务启动中: {startup_state['phase']}")
+    return {"ready": True, "ready_seconds": startup_state['ready_seconds']}
+
+@app.get("/api/capabilities")
+async def get_capabilities(refresh: bool = False):
+    """查看运行环境能力（设备、ffmpeg、可用引擎、模型文件）及启动耗时"""
+    caps = await asyncio.to_thread(probe_capabilities, refresh)
+    return {
+        **caps,
+        "startup": startup_state,
+        "health_latency": health_latency_summary()
+    }
+
+load_popularity()
+
+startup_state['import_seconds'] = round(time.perf_counter() - PROCESS_START, 3)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
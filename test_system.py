@@ -7,6 +7,10 @@
 import requests
 import time
 import sys
+import os
+import tempfile
+import multiprocessing
+from pathlib import Path
 
 API_BASE = "http://localhost:8000"
 
@@ -20,6 +24,10 @@ def test_health():
             print(f"   ✅ 后端运行正常")
             print(f"   - Demucs可用: {data.get('demucs_available', False)}")
             print(f"   - FFmpeg可用: {data.get('ffmpeg_available', False)}")
+            startup = data.get('startup') or {}
+            latency = data.get('health_latency') or {}
+            print(f"   - 就绪: {data.get('ready')} (首个请求距启动 {startup.get('first_request_seconds')} 秒)")
+            print(f"   - /health 平均耗时: {latency.get('avg_ms')} ms")
             return True
         else:
             print(f"   ❌ 后端响应异常: {response.status_code}")
@@ -89,9 +97,95 @@ def test_youtube_processing():
         print(f"   ❌ 错误: {str(e)}")
         return False
 
+def _shared_cache_node(shared_dir, local_dir, barrier, results):
+    """模拟一个节点：抢到租约则计算并发布，否则轮询等待另一节点的结果"""
+    from karaoke_backend import SharedCacheBackend
+
+    backend = SharedCacheBackend(Path(shared_dir), Path(local_dir), lease_seconds=30)
+    owner = f"node-{os.getpid()}"
+    cache_key = "0" * 32
+    barrier.wait()
+
+    if backend.acquire(cache_key, owner):
+        work_dir = Path(local_dir) / "work"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        (work_dir / "vocals.wav").write_bytes(b"vocals")
+        (work_dir / "no_vocals.wav").write_bytes(b"instrumental")
+        time.sleep(1)  # 模拟分离耗时
+        backend.publish(cache_key, str(work_dir / "vocals.wav"), str(work_dir / "no_vocals.wav"), {'title': owner})
+        backend.release(cache_key, owner)
+        results.put('computed')
+        return
+
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        cached = backend.get(cache_key)
+        if cached:
+            # 读穿透：结果应已拉取到本节点的本地目录
+            local_hit = Path(cached['vocals']).parent.parent == Path(local_dir)
+            results.put('waited' if local_hit else 'waited-without-local-copy')
+            return
+        time.sleep(0.2)
+    results.put('timeout')
+
+def _shared_mount_dir():
+    """共享目录的父目录：优先选与本地目录不同的文件系统（模拟 NFS 挂载），
+    可用 KARAOKE_TEST_SHARED_DIR 指定"""
+    if os.environ.get('KARAOKE_TEST_SHARED_DIR'):
+        return os.environ['KARAOKE_TEST_SHARED_DIR']
+    local_dev = os.stat(tempfile.gettempdir()).st_dev
+    shm = Path('/dev/shm')
+    if shm.is_dir() and os.access(shm, os.W_OK) and os.stat(shm).st_dev != local_dev:
+        return str(shm)
+    return None
+
+def test_shared_cache_locking():
+    """测试多节点共享缓存：两个进程共享临时目录，只有一个计算"""
+    print("\n🔍 测试3: 多节点共享缓存加锁...")
+    with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory(dir=_shared_mount_dir()) as mount:
+        shared_dir = f"{mount}/shared"
+        cross_fs = os.stat(tmp).st_dev != os.stat(mount).st_dev
+        print(f"   - 共享目录与本地目录{'位于不同' if cross_fs else '位于同一'}文件系统")
+
+        ctx = multiprocessing.get_context('spawn')
+        barrier = ctx.Barrier(2)
+        results = ctx.Queue()
+        nodes = [
+            ctx.Process(target=_shared_cache_node,
+                        args=(shared_dir, f"{tmp}/node{i}", barrier, results))
+            for i in range(2)
+        ]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join(60)
+
+        outcome = sorted(results.get(timeout=5) for _ in nodes)
+        if not (Path(shared_dir) / ("0" * 32) / "vocals.wav").exists():
+            print("   ❌ 共享目录中没有发布的条目")
+            return False
+        if outcome != ['computed', 'waited']:
+            print(f"   ❌ 结果异常: {outcome}")
+            return False
+        print("   ✅ 只有一个节点计算，另一个节点等待并读取到本地")
+
+        # 一个节点删除后，另一个节点不应继续使用本地副本
+        from karaoke_backend import SharedCacheBackend
+        node0, node1 = (SharedCacheBackend(Path(shared_dir), Path(f"{tmp}/node{i}")) for i in range(2))
+        node0.delete("0" * 32)
+        if node1.get("0" * 32) is not None or node1.local.contains("0" * 32):
+            print("   ❌ 删除后其他节点仍返回本地副本")
+            return False
+        print("   ✅ 删除后其他节点的本地副本随之失效")
+        return True
+
 def main():
     print("🎤 卡拉OK系统测试")
     print("=" * 50)
+
+    # 离线测试：不需要启动后端
+    if '--shared-cache' in sys.argv:
+        sys.exit(0 if test_shared_cache_locking() else 1)
     
     # 测试1: 健康检查
     if not test_health():
@@ -119,6 +213,7 @@ def main():
     print("- 前端访问: 在浏览器中打开前端应用")
     print("- API文档: http://localhost:8000/docs")
     print("- 健康检查: http://localhost:8000/health")
+    print("- 共享缓存测试: python3 test_system.py --shared-cache")
 
 if __name__ == "__main__":
     main()